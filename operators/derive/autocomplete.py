@@ -1,3 +1,4 @@
+import copy
 import math
 import re
 import tempfile
@@ -13,6 +14,7 @@ from dataflows_ckan import dump_to_ckan
 from conf import settings
 
 from srm_tools.logger import logger
+from srm_tools.fast_load import load_trusted
 
 TEMPLATES = [
     '{response}',
@@ -37,6 +39,12 @@ IGNORE_SITUATIONS = {
     'human_situations:age_group:adults',
 }
 
+# The fields of the generated rows, which are aggregated per query
+QUERY_FIELDS = [
+    'query', 'query_heb', 'response', 'situation', 'synonyms', 'org_id', 'org_name', 'city_name',
+    'response_name', 'situation_name', 'structured_query', 'visible', 'low', 'importance',
+]
+
 PKRE = re.compile('[0-9a-zA-Zא-ת]+')
 VERIFY_ORG_ID = re.compile('^(srm|)[0-9]+$')
 VERIFY_CITY_NAME = re.compile('''^[א-ת-`"' ]+$''')
@@ -138,6 +146,56 @@ def unwind_templates():
     return func
 
 
+def aggregate_queries():
+    """Merge the rows of each query, in a single pass and in memory.
+
+    A query takes the first non empty value of each field from its most important rows (lowest importance first,
+    then in order of arrival), is low only if all of its rows are, and is scored by its number of rows.
+    Queries are emitted sorted, as a new autocomplete resource of these fields only.
+    """
+    def aggregate(rows):
+        queries = dict()
+        for row in rows:
+            entry = queries.get(row['query'])
+            if entry is None:
+                entry = queries[row['query']] = dict(score=0, low=None, values=dict())
+            entry['score'] += 1
+            if row['low'] is not None:
+                entry['low'] = row['low'] if entry['low'] is None else min(entry['low'], row['low'])
+            importance, values = row['importance'], entry['values']
+            for field in QUERY_FIELDS:
+                value = row[field]
+                if value is not None and (field not in values or importance < values[field][0]):
+                    values[field] = (importance, value)
+        for query in sorted(queries):
+            entry = queries.pop(query)
+            ret = dict((field, None) for field in QUERY_FIELDS)
+            ret.update((field, value) for field, (_, value) in entry['values'].items())
+            ret.update(low=entry['low'], score=entry['score'])
+            yield ret
+
+    def func(package):
+        resources = package.pkg.descriptor['resources']
+        for i, resource in enumerate(resources):
+            if resource['name'] == 'autocomplete':
+                fields = dict((f['name'], f) for f in resource['schema']['fields'])
+                resources[i] = dict(
+                    name='autocomplete', path='data/autocomplete.csv',
+                    schema=dict(fields=[
+                        *[
+                            copy.deepcopy(fields[name]) if name != 'low' else dict(name='low', type='boolean')
+                            for name in QUERY_FIELDS
+                        ],
+                        dict(name='score', type='integer'),
+                    ]),
+                )
+        yield package.pkg
+        for rows in package:
+            yield aggregate(rows) if rows.res.name == 'autocomplete' else rows
+
+    return func
+
+
 def get_bounds():
     location_keys, location_mapping = prepare_locations()
     cache = dict()
@@ -165,7 +223,7 @@ def get_bounds():
 def autocomplete_flow():
 
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
         DF.update_resource(-1, name='autocomplete'),
         DF.add_field('query', 'string'),
         DF.add_field('query_heb', 'string'),
@@ -182,15 +240,7 @@ def autocomplete_flow():
         DF.add_field('low', 'boolean'),
         DF.add_field('importance', 'integer'),
         unwind_templates(),
-        DF.sort_rows(['importance']),
-        DF.join_with_self('autocomplete', ['query'], fields=dict(
-            score=dict(aggregate='count'),
-            query=None, query_heb=dict(aggregate='first'), importance=dict(aggregate='first'),
-            response=dict(aggregate='first'), situation=dict(aggregate='first'), synonyms=dict(aggregate='first'), 
-            org_id=dict(aggregate='first'), org_name=dict(aggregate='first'), city_name=dict(aggregate='first'),
-            response_name=dict(aggregate='first'), situation_name=dict(aggregate='first'), structured_query=dict(aggregate='first'), 
-            visible=dict(aggregate='first'), low=dict(aggregate='min'),
-        )),
+        aggregate_queries(),
         DF.add_field('bounds', 'array', **{'es:itemType': 'number', 'es:index': False}),
         get_bounds(),
         DF.set_type('score', type='number', transform=lambda v: (math.log(v) + 1)**2),
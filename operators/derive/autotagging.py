@@ -4,9 +4,8 @@ from dataflows_airtable import load_from_airtable
 from conf import settings
 
 
-def apply_auto_tagging():
-
-    rules = DF.Flow(
+def load_auto_tagging_rules():
+    return DF.Flow(
         load_from_airtable(settings.AIRTABLE_DATAENTRY_BASE, 'Auto Tagging', settings.AIRTABLE_VIEW, settings.AIRTABLE_API_KEY),
         DF.rename_fields({
             'Query': 'query',
@@ -19,6 +18,12 @@ def apply_auto_tagging():
         DF.select_fields(['fields', 'query', 'situation_ids', 'response_ids']),
     ).results()[0][0]
 
+
+def apply_auto_tagging(rules=None):
+
+    if rules is None:
+        rules = load_auto_tagging_rules()
+
     def func(rows):
         for row in rows:
             row['auto_tagged'] = row.get('auto_tagged') or []
@@ -0,0 +1,98 @@
+import os
+
+import dataflows as DF
+
+from conf import settings
+from srm_tools.hash import content_hash
+from srm_tools.fast_load import load_trusted
+from srm_tools.logger import logger
+
+CARD_HASHES = f'{settings.DATA_DUMP_DIR}/card_hashes'
+CARD_CHANGESET = f'{settings.DATA_DUMP_DIR}/card_changeset'
+
+ADDED = 'added'
+MODIFIED = 'modified'
+REMOVED = 'removed'
+
+
+def dump_rows(rows, path, name, title, fields, **properties):
+    descriptor = dict(
+        name=name,
+        resources=[dict(name=name, path=f'{name}.csv', schema=dict(fields=fields))]
+    )
+    DF.Flow(
+        DF.load((descriptor, [iter(rows)])),
+        DF.update_package(name=name, title=title, **properties),
+        DF.dump_to_path(path),
+    ).process()
+
+
+def load_card_hashes(path=CARD_HASHES):
+    """Card id -> content hash, as recorded by the last successful run."""
+    if not os.path.exists(f'{path}/datapackage.json'):
+        return dict()
+    rows = DF.Flow(
+        load_trusted(f'{path}/datapackage.json'),
+    ).results()[0][0]
+    return dict((row['card_id'], row['hash']) for row in rows)
+
+
+def load_card_changeset(path=CARD_CHANGESET):
+    """Changed cards of the last run, as a dict of change type -> list of (card_id, hash)."""
+    if not os.path.exists(f'{path}/datapackage.json'):
+        return None
+    ret = dict((change, []) for change in (ADDED, MODIFIED, REMOVED))
+    rows = DF.Flow(
+        load_trusted(f'{path}/datapackage.json'),
+    ).results()[0][0]
+    for row in rows:
+        ret[row['change']].append((row['card_id'], row['hash']))
+    return ret
+
+
+def card_changeset(snapshot=f'{settings.DATA_DUMP_DIR}/card_data', resource='card_data'):
+    """Hash every card of a dumped snapshot and publish the added, modified and removed cards compared to the previous run.
+
+    Run once the snapshot's dump has completed (its datapackage.json is written last), so hashes are only recorded
+    for a published snapshot.
+    """
+    previous = load_card_hashes()
+    current = dict()
+
+    def hash_cards(rows):
+        for row in rows:
+            current[row['card_id']] = content_hash(row)
+            yield row
+
+    DF.Flow(
+        load_trusted(f'{snapshot}/datapackage.json', resources=[resource]),
+        hash_cards,
+    ).process()
+
+    changes = []
+    for card_id, card_hash in current.items():
+        previous_hash = previous.get(card_id)
+        if previous_hash is None:
+            changes.append(dict(card_id=card_id, change=ADDED, hash=card_hash))
+        elif previous_hash != card_hash:
+            changes.append(dict(card_id=card_id, change=MODIFIED, hash=card_hash))
+    for card_id, card_hash in previous.items():
+        if card_id not in current:
+            changes.append(dict(card_id=card_id, change=REMOVED, hash=card_hash))
+
+    counts = dict((change, 0) for change in (ADDED, MODIFIED, REMOVED))
+    for change in changes:
+        counts[change['change']] += 1
+    logger.info('CARD CHANGESET: {} cards, {added} added, {modified} modified, {removed} removed'.format(len(current), **counts))
+
+    dump_rows(
+        changes, CARD_CHANGESET, 'card_changeset', 'Card Data Changeset',
+        [dict(name='card_id', type='string'), dict(name='change', type='string'), dict(name='hash', type='string')],
+        changes=counts, count_of_cards=len(current),
+    )
+    dump_rows(
+        (dict(card_id=card_id, hash=card_hash) for card_id, card_hash in current.items()),
+        CARD_HASHES, 'card_hashes', 'Card Data Hashes',
+        [dict(name='card_id', type='string'), dict(name='hash', type='string')],
+    )
+    return counts
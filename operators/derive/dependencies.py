@@ -0,0 +1,301 @@
+import os
+import ast
+import shutil
+import importlib
+import importlib.util
+
+import dataflows as DF
+from dataflows.helpers.resource_matcher import ResourceMatcher
+
+from conf import settings
+from srm_tools.hash import content_hash
+from srm_tools.fast_load import load_trusted
+from srm_tools.logger import logger
+
+from .changeset import dump_rows
+
+SOURCE_HASHES = f'{settings.DATA_DUMP_DIR}/srm_data_hashes'
+# Cards as they were before scoring, which is where cards of unaffected organizations are spliced in
+CARD_SOURCES = f'{settings.DATA_DUMP_DIR}/card_sources'
+
+TAXONOMY_RESOURCES = ['responses', 'situations']
+ENTITY_RESOURCES = ['organizations', 'locations', 'branches', 'services']
+# Inputs which every card depends on - any change to these requires a full rebuild
+GLOBAL_RESOURCE = 'global'
+# The module deriving cards - its code, and that of every local module it imports, determines the content of cards
+DERIVATION_MODULE = 'operators.derive.to_dp'
+LOCAL_PACKAGES = ['operators', 'srm_tools']
+# Settings which change the content of cards
+DERIVATION_SETTINGS = ['DERIVE_FUZZY_BRANCH_MERGE']
+# Card fields which refer to taxonomy entries, either by key or by id
+CARD_TAXONOMY_FIELDS = [
+    'service_situations', 'branch_situations', 'organization_situations', 'service_responses',
+    'situation_ids', 'response_ids',
+]
+
+SOURCE_HASH_FIELDS = [
+    dict(name='resource', type='string'),
+    dict(name='key', type='string'),
+    dict(name='hash', type='string'),
+    dict(name='organizations', type='array'),
+    dict(name='branches', type='array'),
+    dict(name='locations', type='array'),
+    dict(name='taxonomy', type='array'),
+]
+
+
+def iterate_rows(*steps):
+    for res in DF.Flow(*steps).datastream().res_iter:
+        yield from res
+
+
+def imported_modules(module):
+    """Names of the local modules imported by a module."""
+    with open(module.__file__, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    candidates = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            candidates.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = importlib.util.resolve_name('.' * node.level + (node.module or ''), module.__package__)
+            # Imported names may be modules too (from . import helpers)
+            candidates.append(base)
+            candidates.extend(f'{base}.{alias.name}' for alias in node.names)
+    ret = []
+    for name in candidates:
+        if name.split('.')[0] not in LOCAL_PACKAGES:
+            continue
+        try:
+            if importlib.util.find_spec(name) is not None:
+                ret.append(name)
+        except ModuleNotFoundError:
+            # A name imported from a module, rather than a submodule
+            continue
+    return ret
+
+
+def derivation_modules(root=DERIVATION_MODULE):
+    """The module deriving cards, and all the local modules it imports, directly or indirectly."""
+    ret = set()
+    pending = [root]
+    while pending:
+        name = pending.pop()
+        if name in ret:
+            continue
+        module = importlib.import_module(name)
+        if hasattr(module, '__path__'):
+            # Packages only wire up their modules' flows
+            continue
+        ret.add(name)
+        pending.extend(imported_modules(module))
+    return sorted(ret)
+
+
+def code_fingerprint(modules=None):
+    sources = dict()
+    for name in modules or derivation_modules():
+        with open(importlib.import_module(name).__file__, encoding='utf-8') as f:
+            sources[name] = f.read()
+    return content_hash(sources)
+
+
+def source_records(rules):
+    """Hash every record of the srm_data package, along with the entities it refers to."""
+    records = dict()
+
+    def record(resource, key, row, organizations=None, branches=None, locations=None, taxonomy=None):
+        records[(resource, key)] = dict(
+            resource=resource, key=key, hash=content_hash(row),
+            organizations=organizations or [], branches=branches or [], locations=locations or [], taxonomy=taxonomy or [],
+        )
+
+    ds = DF.Flow(
+        load_trusted(f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json', resources=TAXONOMY_RESOURCES + ENTITY_RESOURCES),
+    ).datastream()
+    for res in ds.res_iter:
+        name = res.res.name
+        for row in res:
+            if name == 'branches':
+                record(name, row['key'], row, organizations=row.get('organization'), locations=row.get('location'))
+            elif name == 'services':
+                record(name, row['key'], row, organizations=row.get('organizations'), branches=row.get('branches'))
+            elif name in TAXONOMY_RESOURCES:
+                # Cards refer to taxonomy entries by both key and id
+                record(name, row['key'], row, taxonomy=[row['key'], row['id']])
+            else:
+                record(name, row['key'], row)
+    record(GLOBAL_RESOURCE, 'auto_tagging', rules)
+    record(GLOBAL_RESOURCE, 'code', code_fingerprint())
+    record(GLOBAL_RESOURCE, 'settings', dict((name, getattr(settings, name)) for name in DERIVATION_SETTINGS))
+    return records
+
+
+def load_source_records(path=SOURCE_HASHES):
+    if not os.path.exists(f'{path}/datapackage.json'):
+        return None
+    rows = DF.Flow(
+        load_trusted(f'{path}/datapackage.json'),
+    ).results()[0][0]
+    return dict(((row['resource'], row['key']), row) for row in rows)
+
+
+def changed_records(previous, current):
+    return [
+        key for key in set(previous) | set(current)
+        if (previous.get(key) or {}).get('hash') != (current.get(key) or {}).get('hash')
+    ]
+
+
+def taxonomy_organizations(taxonomy, path=CARD_SOURCES):
+    """Organizations having cards which refer to any of the given taxonomy keys or ids."""
+    ret = set()
+    for row in iterate_rows(
+        load_trusted(f'{path}/datapackage.json'),
+        DF.select_fields(['organization_key'] + CARD_TAXONOMY_FIELDS),
+    ):
+        if any(t in taxonomy for field in CARD_TAXONOMY_FIELDS for t in row[field] or []):
+            ret.add(row['organization_key'])
+    return ret
+
+
+def affected_organizations(changed, previous, current):
+    """Organizations whose cards may change, given the changed source records.
+
+    References are followed in both the previous and the current snapshot, so that moving an entity
+    between organizations affects both of them.
+    """
+    snapshots = (previous, current)
+    location_branches = dict()
+    for snapshot in snapshots:
+        for (resource, key), rec in snapshot.items():
+            if resource == 'branches':
+                for location in rec['locations']:
+                    location_branches.setdefault(location, set()).add(key)
+
+    def branch_organizations(branch):
+        return set(
+            org
+            for snapshot in snapshots
+            for org in (snapshot.get(('branches', branch)) or {}).get('organizations') or []
+        )
+
+    ret = set()
+    taxonomy = set()
+    for resource, key in changed:
+        recs = [rec for rec in (snapshot.get((resource, key)) for snapshot in snapshots) if rec]
+        if resource == 'organizations':
+            ret.add(key)
+        elif resource == 'branches':
+            ret |= branch_organizations(key)
+        elif resource == 'locations':
+            for branch in location_branches.get(key, []):
+                ret |= branch_organizations(branch)
+        elif resource == 'services':
+            for rec in recs:
+                ret.update(rec['organizations'])
+                for branch in rec['branches']:
+                    ret |= branch_organizations(branch)
+        elif resource in TAXONOMY_RESOURCES:
+            for rec in recs:
+                taxonomy.update(rec['taxonomy'])
+    if taxonomy:
+        ret |= taxonomy_organizations(taxonomy)
+    return ret
+
+
+class DerivePlan():
+    """Which organizations' cards need to be derived in this run.
+
+    A full plan derives all cards. An incremental plan derives only the cards of the affected
+    organizations up to scoring, and splices in the rest of the cards from the previous run at that point -
+    scoring and everything after it still runs on all cards, as scores depend on all of them.
+    The flat_branches, flat_services and flat_table snapshots are always complete, the plan only restricts
+    the card flow. Processing stats and reports of the card steps before scoring only cover the cards derived
+    in this run.
+    """
+
+    def __init__(self, records, organizations=None, reason=None):
+        self.records = records
+        self.organizations = organizations
+        self.reason = reason
+
+    @property
+    def full(self):
+        return self.organizations is None
+
+    def includes(self, organization_key):
+        return self.full or organization_key in self.organizations
+
+    def restrict(self, field, resources=None):
+        """Keep only rows belonging to organizations in this plan."""
+        if self.full:
+            return None
+        return DF.filter_rows(lambda row: self.includes(row[field]), resources=resources)
+
+    def splice_retained_cards(self, resources=None):
+        """Add the cards of organizations which were not derived in this run, as stored by the previous run."""
+
+        def process_resource(rows, field_names):
+            derived = set()
+            for row in rows:
+                derived.add(row['card_id'])
+                yield row
+
+            count = 0
+            for row in iterate_rows(load_trusted(f'{CARD_SOURCES}/datapackage.json')):
+                if not self.includes(row['organization_key']) and row['card_id'] not in derived:
+                    count += 1
+                    yield dict((name, row.get(name)) for name in field_names)
+            logger.info('INCREMENTAL DERIVE: {} cards derived, {} retained from the previous run'.format(len(derived), count))
+
+        def func(package: DF.PackageWrapper):
+            matcher = ResourceMatcher(resources, package.pkg)
+            yield package.pkg
+            for rows in package:
+                if not self.full and matcher.match(rows.res.name):
+                    field_names = [field['name'] for field in rows.res.descriptor['schema']['fields']]
+                    yield process_resource(rows, field_names)
+                else:
+                    yield rows
+
+        return func
+
+    def store_cards(self):
+        """Store all cards before scoring, for the next run to splice from."""
+        return DF.dump_to_path(f'{CARD_SOURCES}.next')
+
+    def commit(self):
+        """Record the source snapshot and the stored cards, once the card snapshot was written."""
+        dump_rows(self.records.values(), SOURCE_HASHES, 'srm_data_hashes', 'SRM Data Hashes', SOURCE_HASH_FIELDS)
+        shutil.rmtree(CARD_SOURCES, ignore_errors=True)
+        os.rename(f'{CARD_SOURCES}.next', CARD_SOURCES)
+
+
+def plan_derivation(rules):
+    """Decide between a full and an incremental derivation, based on changes in the srm_data package."""
+    current = source_records(rules)
+    organizations = None
+    reason = None
+
+    previous = load_source_records()
+    if not settings.INCREMENTAL_DERIVE:
+        reason = 'incremental derivation is disabled'
+    elif previous is None or not os.path.exists(f'{CARD_SOURCES}/datapackage.json'):
+        reason = 'no previous run'
+    else:
+        changed = changed_records(previous, current)
+        all_organizations = set(key for resource, key in current if resource == 'organizations')
+        if any(resource == GLOBAL_RESOURCE for resource, _ in changed):
+            reason = 'auto tagging rules, code or settings changed'
+        else:
+            organizations = affected_organizations(changed, previous, current)
+            if len(organizations) > settings.INCREMENTAL_DERIVE_MAX_FRACTION * len(all_organizations):
+                reason = '{} of {} organizations changed'.format(len(organizations), len(all_organizations))
+                organizations = None
+
+    if organizations is None:
+        logger.info('FULL DERIVE: {}'.format(reason))
+    else:
+        logger.info('INCREMENTAL DERIVE: {} changed records, {} affected organizations'.format(len(changed), len(organizations)))
+    return DerivePlan(current, organizations, reason)
@@ -0,0 +1,289 @@
+import os
+import re
+import sys
+import json
+import math
+import random
+import tempfile
+import fnmatch
+import argparse
+
+import dataflows as DF
+from tableschema_elasticsearch.mappers import descriptor_to_mapping
+
+from conf import settings
+from srm_tools.logger import logger
+from srm_tools.fast_load import load_trusted
+
+from . import to_es
+from .es_utils import SRMMappingGenerator, DOC_VALUES_TYPES, TEXT_TYPES, dump_override
+
+SAMPLE_SIZE = 2000
+# Indexes which are dumped to disk by their flows before being indexed, with the resource holding their documents
+DUMPED_INDEXES = dict(
+    srm__responses=('response_data', 'responses'),
+    srm__situations=('situation_data', 'situations'),
+    srm__places=('place_data', 'places'),
+)
+
+# A rough model of Lucene's on-disk cost, in bytes, good enough for comparing fields with each other
+POSTING_BYTES = dict(docs=1, freqs=2, positions=3, offsets=4)
+NORMS_BYTES = 1
+POINT_BYTES = dict(long=8, scaled_float=8, date=8, geo_point=8, boolean=1, rank_feature=4)
+# search_as_you_type indexes shingles of 2 and 3 terms, and edge ngrams of the longest shingles
+SEARCH_AS_YOU_TYPE_FIELDS = 4
+TOKEN_RE = re.compile(r'\w+')
+
+
+def flatten(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [v for item in value for v in flatten(item)]
+    return [value]
+
+
+def leaf_fields(properties, doc, prefix=''):
+    """(path, mapping, values) of the leaf fields of a document, according to its mapping."""
+    for name, prop in properties.items():
+        values = flatten(doc.get(name)) if isinstance(doc, dict) else []
+        path = prefix + name
+        if prop.get('properties') and prop.get('enabled', True):
+            for value in values:
+                yield from leaf_fields(prop['properties'], value, path + '.')
+        else:
+            yield path, prop, values
+
+
+class FieldCost():
+    """Accumulated cost estimates of a field over the sampled documents."""
+
+    def __init__(self, prop, profile=None):
+        self.prop = prop
+        self.profile = profile
+        self.type = prop.get('type', 'object')
+        self.stored = 0
+        self.postings = 0
+        self.doc_values = 0
+        self.values = 0
+        self.terms = set()
+
+    def add(self, values):
+        prop, type_ = self.prop, self.type
+        indexed = prop.get('index', True) and prop.get('enabled', True) and type_ != 'object'
+        self.values += len(values)
+        if type_ in TEXT_TYPES:
+            if indexed:
+                tokens = [t for v in values for t in TOKEN_RE.findall(str(v).lower())]
+                self.terms.update(tokens)
+                copies = (SEARCH_AS_YOU_TYPE_FIELDS if type_ == 'search_as_you_type' else 1) + len(prop.get('fields', {}))
+                posting = POSTING_BYTES[prop.get('index_options', 'positions')]
+                norms = NORMS_BYTES if values and prop.get('norms', True) else 0
+                self.postings += copies * (len(tokens) * posting + norms)
+        elif type_ == 'keyword':
+            values = [str(v) for v in values]
+            if indexed or prop.get('doc_values', True):
+                self.terms.update(values)
+            if indexed:
+                self.postings += len(values) * POSTING_BYTES['docs']
+            if prop.get('doc_values', True):
+                # Ordinals, the terms themselves are counted once in the terms dictionary
+                self.doc_values += len(values)
+        elif type_ in POINT_BYTES:
+            if indexed:
+                self.postings += len(values) * POINT_BYTES[type_]
+            if type_ in DOC_VALUES_TYPES and prop.get('doc_values', True):
+                self.doc_values += len(values) * POINT_BYTES[type_]
+
+    def estimate(self, docs, scale):
+        """Estimated bytes of the field in the full index, from a sample of docs scaled by the given factor."""
+        terms = sum(len(t.encode('utf-8')) for t in self.terms)
+        doc_values = self.doc_values
+        if self.type == 'keyword' and doc_values:
+            # Ordinals take log2(distinct terms) bits each
+            doc_values = doc_values * max(1, math.ceil(math.log2(len(self.terms) + 1))) / 8
+        # Distinct terms don't grow linearly with the documents, so this is an upper bound of the terms dictionary
+        index = self.postings * scale + (terms * scale if self.prop.get('index', True) else 0)
+        doc_values = doc_values * scale + (terms * scale if self.type == 'keyword' and self.doc_values else 0)
+        return dict(
+            type=self.type,
+            profile=self.profile,
+            stored=int(self.stored * scale), index=int(index), doc_values=int(doc_values),
+            eager_global_ordinals=bool(self.prop.get('eager_global_ordinals')),
+            values_per_doc=round(self.values / max(1, docs), 2),
+        )
+
+
+class IndexSample():
+    """A uniform (reservoir) sample of the documents of an index, along with its mapping."""
+
+    def __init__(self, alias, schema, mapper_cls, sample_size):
+        self.alias = alias
+        self.properties = descriptor_to_mapping(schema, mapping_generator_cls=mapper_cls)['properties']
+        self.profiles = dict((f['name'], f.get('es:profile')) for f in schema['fields'])
+        self.sample_size = sample_size
+        self.random = random.Random(0)
+        self.docs = []
+        self.count = 0
+
+    def add(self, doc):
+        self.count += 1
+        if len(self.docs) < self.sample_size:
+            self.docs.append(dict(doc))
+        else:
+            i = self.random.randrange(self.count)
+            if i < self.sample_size:
+                self.docs[i] = dict(doc)
+
+    def costs(self):
+        ret = dict()
+
+        def cost(path, prop):
+            if path not in ret:
+                ret[path] = FieldCost(prop, self.profiles.get(path))
+            return ret[path]
+
+        for doc in self.docs:
+            for name, value in doc.items():
+                if value is not None and name in self.properties:
+                    # As stored in _source
+                    cost(name, self.properties[name]).stored += len(
+                        json.dumps({name: value}, ensure_ascii=False, default=str).encode('utf-8')
+                    )
+            for path, prop, values in leaf_fields(self.properties, doc):
+                cost(path, prop).add(values)
+        scale = self.count / len(self.docs) if self.docs else 0
+        return dict((path, c.estimate(len(self.docs), scale)) for path, c in ret.items())
+
+
+class Sampler(DF.DataStreamProcessor):
+    """Samples the documents of the resources dumped to the given indexes, passing them through."""
+
+    def __init__(self, audit, indexes, mapper_cls):
+        super().__init__()
+        self.audit = audit
+        self.mapper_cls = mapper_cls
+        self.aliases = dict(
+            (spec['resource_name'], alias) for alias, specs in indexes.items() for spec in specs
+        )
+
+    def process_resource(self, resource):
+        alias = self.aliases.get(resource.res.name)
+        if alias is None:
+            return resource
+        sample = self.audit.samples[alias] = IndexSample(
+            alias, resource.res.descriptor['schema'], self.mapper_cls, self.audit.sample_size
+        )
+        return self.sample(sample, resource)
+
+    def sample(self, sample, rows):
+        for row in rows:
+            sample.add(row)
+            yield row
+
+
+class Audit():
+    """Collects samples of the documents of every index dumped while it's running the flows (see dump_override)."""
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.samples = dict()
+
+    def sampler(self, *, indexes, mapper_cls=SRMMappingGenerator, **_):
+        return Sampler(self, indexes, mapper_cls)
+
+    def run(self):
+        """Run the export flows (or load their dumps) without writing to ES, sampling their documents."""
+        with dump_override(self.sampler), tempfile.TemporaryDirectory() as checkpoints:
+            if os.path.exists(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'):
+                # With its own checkpoints, leaving the checkpoint of the real export alone
+                to_es.data_api_es_flow(checkpoint_path=checkpoints)
+            if os.path.exists(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json'):
+                to_es.load_autocomplete_to_es_flow()
+            for alias, (dump, resource) in DUMPED_INDEXES.items():
+                path = f'{settings.DATA_DUMP_DIR}/{dump}/datapackage.json'
+                if not os.path.exists(path):
+                    logger.info(f'No dump of {alias} in {path}, skipping it')
+                    continue
+                DF.Flow(
+                    load_trusted(path, resources=[resource]),
+                    self.sampler(indexes={alias: [dict(resource_name=resource)]}),
+                ).process()
+        return self
+
+
+def load_query_profiles(path):
+    """Field patterns referenced by the API's queries, as a dict of index alias -> list of fnmatch patterns."""
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def report(audit, query_profiles=None):
+    ret = dict()
+    for alias, sample in audit.samples.items():
+        costs = sample.costs()
+        patterns = (query_profiles or {}).get(alias, [])
+        total = sum(c['stored'] + c['index'] + c['doc_values'] for c in costs.values()) or 1
+        for path, cost in costs.items():
+            cost['total'] = cost['stored'] + cost['index'] + cost['doc_values']
+            cost['share'] = round(100 * cost['total'] / total, 1)
+            if query_profiles is not None:
+                # Fields which are indexed, but which no query uses
+                cost['unreferenced'] = (
+                    (cost['index'] > 0 or cost['doc_values'] > 0) and
+                    not any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+                )
+        ret[alias] = dict(
+            docs=sample.count, sampled=len(sample.docs), total=total,
+            fields=dict(sorted(costs.items(), key=lambda x: -x[1]['total'])),
+        )
+    return ret
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GB'
+
+
+def print_report(result, top=25, out=sys.stdout):
+    for alias, entry in result.items():
+        print(f"\n{alias}: {entry['docs']} documents ({entry['sampled']} sampled), ~{format_size(entry['total'])}", file=out)
+        print(f"{'field':40} {'type':14} {'stored':>8} {'index':>8} {'docvals':>8} {'share':>6}", file=out)
+        for path, cost in list(entry['fields'].items())[:top]:
+            flags = ' '.join(filter(None, [
+                cost['profile'] and f"[{cost['profile']}]",
+                cost['eager_global_ordinals'] and 'eager-ordinals',
+                cost.get('unreferenced') and 'UNREFERENCED',
+            ]))
+            print(
+                f"{path[:40]:40} {cost['type'][:14]:14} {format_size(cost['stored']):>8} {format_size(cost['index']):>8} "
+                f"{format_size(cost['doc_values']):>8} {cost['share']:>5}% {flags}", file=out
+            )
+        unreferenced = [path for path, cost in entry['fields'].items() if cost.get('unreferenced')]
+        if unreferenced:
+            print(f'Indexed but never queried: {", ".join(unreferenced)}', file=out)
+
+
+def operator(*_, sample_size=SAMPLE_SIZE, query_profiles=None, output=None):
+    logger.info('Starting ES Footprint Audit')
+    audit = Audit(sample_size).run()
+    result = report(audit, load_query_profiles(query_profiles or settings.ES_QUERY_PROFILES))
+    print_report(result)
+    output = output or f'{settings.DATA_DUMP_DIR}/es_footprint.json'
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    logger.info(f'Finished ES Footprint Audit, full report in {output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the per-field footprint of the SRM indexes, without ES')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE)
+    parser.add_argument('--query-profiles', help='JSON file of index alias -> field patterns used by queries')
+    parser.add_argument('--output', help='Path of the JSON report')
+    args = parser.parse_args()
+    operator(None, None, None, sample_size=args.sample_size, query_profiles=args.query_profiles, output=args.output)
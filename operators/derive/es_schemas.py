@@ -38,13 +38,21 @@ NON_INDEXED_ADDRESS_PARTS_SCHEMA = {
     }
 }
 
-NON_INDEXED_STRING = {'es:itemType': 'string', 'es:index': False}
+NON_INDEXED_STRING = {'es:itemType': 'string', 'es:index': False, 'es:profile': 'display'}
+NON_INDEXED_OBJECT = {'es:index': False}
 KEYWORD_STRING = {'es:itemType': 'string', 'es:keyword': True}
 KEYWORD_ONLY = {'es:keyword': True}
 ITEM_TYPE_STRING = {'es:itemType': 'string'}
 ITEM_TYPE_NUMBER = {'es:itemType': 'number'}
 AUTOCOMPLETE_STRING = {'es:autocomplete': True}
 NO_SCHEMA = {}
+RANK_FEATURE = {'es:rankFeature': True}
+
+# Mapping profiles, see es_utils.apply_profile
+SEARCH_PROFILE = {'es:profile': 'search'}
+FILTER_PROFILE = {'es:profile': 'filter'}
+AGGREGATE_PROFILE = {'es:profile': 'aggregate'}
+DISPLAY_PROFILE = {'es:profile': 'display'}
 
 LAST_MODIFIED_DATE = {
     'es:itemType': 'date',
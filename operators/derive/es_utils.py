@@ -1,21 +1,120 @@
+import os
+import re
+import json
 import uuid
-import time
+import shutil
+import datetime
+import threading
+import contextlib
+from multiprocessing.pool import ThreadPool
 
 import dataflows as DF
+from dataflows.processors.dumpers.dumper_base import DumperBase
 
 import elasticsearch
+from elasticsearch.helpers import bulk
 from dataflows_elasticsearch import dump_to_es
-from tableschema_elasticsearch.mappers import MappingGenerator
+from tableschema_elasticsearch import Storage
+from tableschema_elasticsearch.mappers import MappingGenerator, descriptor_to_mapping
 
 from conf import settings
+from srm_tools.hash import content_hash
+from srm_tools.fast_load import load_trusted
+
+from .changeset import dump_rows
+
+INDEX_SETTINGS = dict(
+    number_of_shards=settings.ES_INDEX_SHARDS,
+    number_of_replicas=settings.ES_INDEX_REPLICAS,
+)
+# New indexes aren't searched until they're swapped in, so they're loaded without refreshes and replicas
+LOADING_SETTINGS = dict(
+    refresh_interval=-1,
+    number_of_replicas=0,
+)
+# Field mapping profiles (es:profile), by how fields are used - see apply_profile
+PROFILES = ('search', 'filter', 'aggregate', 'display')
+DOC_VALUES_TYPES = ('keyword', 'long', 'scaled_float', 'date', 'boolean', 'geo_point')
+TEXT_TYPES = ('text', 'search_as_you_type')
+MANIFEST_FIELDS = [
+    dict(name='id', type='string'),
+    dict(name='hash', type='string'),
+]
+
+
+_client = None
+_client_available = False
+_client_lock = threading.Lock()
+# Called with the arguments of dump_to_es_and_delete instead of dumping to ES, see dump_override
+_dump_override = None
 
 
 def es_instance():
-    return elasticsearch.Elasticsearch(
-        [dict(host=settings.ES_HOST, port=int(settings.ES_PORT))],
-        timeout=60, retry_on_timeout=True, max_retries=3, retry_on_status=[502, 503, 504],
-        **({"http_auth": settings.ES_HTTP_AUTH.split(':')} if settings.ES_HTTP_AUTH else {}),
-    )
+    """The ES client shared by the whole process.
+
+    Its connection pool keeps connections alive across flows, requests are compressed, and requests which
+    timed out or were rejected by an overloaded cluster are retried.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = elasticsearch.Elasticsearch(
+                [dict(host=settings.ES_HOST, port=int(settings.ES_PORT))],
+                timeout=settings.ES_TIMEOUT, retry_on_timeout=True, max_retries=settings.ES_MAX_RETRIES,
+                retry_on_status=[429, 502, 503, 504],
+                http_compress=True, maxsize=settings.ES_CONNECTIONS,
+                sniff_on_start=False, sniff_on_connection_fail=False,
+                **({"http_auth": settings.ES_HTTP_AUTH.split(':')} if settings.ES_HTTP_AUTH else {}),
+            )
+    return _client
+
+
+def es_available():
+    """Whether ES can be reached, pinging it only until it could be reached once."""
+    global _client_available
+    if not _client_available:
+        try:
+            _client_available = es_instance().ping()
+        except Exception:
+            _client_available = False
+    return _client_available
+
+
+def apply_profile(prop, profile, name):
+    """Tune a field's mapping to how it's used, keeping only the index structures it needs.
+
+    search - full text or range searches: indexed, without doc values.
+    filter - exact matches, which aren't scored: indexed, without doc values, norms or term frequencies.
+    aggregate - terms aggregations, sorting and collapsing: doc values, with global ordinals built on refresh
+    instead of on the first aggregation.
+    display - only returned with documents: not indexed at all.
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown es:profile {!r} for field {}'.format(profile, name))
+    type_ = prop.get('type')
+    if type_ is None:
+        # Objects
+        if profile == 'display':
+            prop.update(properties={}, enabled=False)
+        return prop
+    if profile == 'display':
+        prop.pop('fields', None)
+        prop['index'] = False
+        if type_ in DOC_VALUES_TYPES:
+            prop['doc_values'] = False
+    elif profile in ('search', 'filter'):
+        prop['index'] = True
+        if type_ in DOC_VALUES_TYPES:
+            prop['doc_values'] = False
+        if profile == 'filter' and type_ in TEXT_TYPES:
+            prop.update(norms=False, index_options='docs')
+    elif profile == 'aggregate':
+        if type_ in TEXT_TYPES:
+            raise ValueError('Field {} must be a keyword or numeric field to be aggregated'.format(name))
+        prop.update(index=True, doc_values=True)
+        if type_ == 'keyword':
+            prop['eager_global_ordinals'] = True
+    return prop
 
 
 class SRMMappingGenerator(MappingGenerator):
@@ -25,46 +124,419 @@ class SRMMappingGenerator(MappingGenerator):
         if field['type'] == 'any':
             field['es:itemType'] = 'string'
         prop = super()._convert_type(schema_type, field, prefix)
+        if field.get('es:rankFeature'):
+            # Static ranking signals, for rank_feature queries instead of script scoring
+            return dict(type='rank_feature', positive_score_impact=field.get('es:positiveScoreImpact', True))
         keyword, autocomplete, hebrew = field.get('es:keyword'), field.get('es:autocomplete'), field.get('es:hebrew')
+        analyzer = field.get('es:analyzer')
         if keyword:
             prop['type'] = 'keyword'
         if autocomplete:
             prop['type'] = 'search_as_you_type'
         if schema_type in ('number', 'integer', 'geopoint'):
             prop['index'] = True
-        if hebrew or field['name'].split('_')[-1] in ('name', 'purpose', 'description', 'details', 'synonyms', 'heb'):
+        if analyzer:
+            # Text which was already normalized, analyzed by a single (index level) analyzer
+            prop['analyzer'] = analyzer
+        elif hebrew or field['name'].split('_')[-1] in ('name', 'purpose', 'description', 'details', 'synonyms', 'heb'):
             prop['fields'] = {
                 'hebrew': {
                     'type': 'text',
                     'analyzer': 'hebrew'
                 }
             }
+        profile = field.get('es:profile')
+        if profile:
+            prop = apply_profile(prop, profile, field['name'])
 
         return prop
 
 
-def dump_to_es_and_delete(**kwargs):
-    unique_id = uuid.uuid4().hex
-    engine: elasticsearch.Elasticsearch = es_instance()
+class AliasSwapDumper(dump_to_es):
+    """Dump resources into fresh, versioned indexes, and swap the aliases to them once all rows were written.
+
+    Searches keep hitting the previous index until the swap, which is atomic. The previous indexes
+    (and leftovers of failed runs) are deleted after it.
+
+    manifests - a dict of alias -> path of a manifest of the content hashes of its documents. When the
+    manifest matches the index currently behind the alias (and the mapping didn't change), only new,
+    changed and deleted documents are written to that index instead of rebuilding it.
+    force_merge - merge new indexes into a single segment before swapping them in, for indexes which
+    are only written by rebuilding them.
+    alias_settings - a dict of alias -> index settings for that alias, on top of index_settings
+    (e.g. index sorting, which depends on the alias's fields).
+    routing - a dict of alias -> field whose value is used as the routing of the alias's documents, keeping
+    documents with the same value (e.g. a collapse key) on the same shard. Routed aliases are always rebuilt,
+    as updating a document whose routing changed in place would leave its previous copy on another shard.
+
+    sources - a dict of alias -> paths of the datapackage.json files its documents are derived from.
+
+    Documents of new indexes are written in chunks, and the digests of acknowledged chunks are kept in a
+    checkpoint of the alias (see ES_RESUMABLE_BULK). When a run fails before the swap, the next run with the
+    same mapping and the same sources resumes writing to the same index, skipping the chunks which were already
+    written. Aliases without sources are always written from scratch, as a changed input could leave documents
+    of the failed run behind. Document counts are verified before swapping.
+    """
+
+    def __init__(self, *, indexes, manifests=None, force_merge=False, alias_settings=None, routing=None, sources=None,
+                 **kwargs):
+        kwargs.setdefault('index_settings', INDEX_SETTINGS)
+        super().__init__(indexes=indexes, **kwargs)
+        self.manifests = manifests or dict()
+        self.force_merge = force_merge
+        self.alias_settings = alias_settings or dict()
+        self.routing = routing or dict()
+        self.sources = sources or dict()
+        self.revisions = dict()
+
+    def initialize(self):
+        if self.connection_info is es_instance():
+            # The shared client was already checked by es_available, unlike ESDumper.initialize this doesn't ping ES
+            DumperBase.initialize(self)
+            self.engine = self.connection_info
+            self.converted_resources = dict()
+            for alias, specs in self.index_to_resource.items():
+                for spec in specs:
+                    spec['index_name'] = alias
+                    self.converted_resources[spec.get('resource-name', spec.get('resource_name'))] = spec
+        else:
+            super().initialize()
+        # alias -> new index, for aliases which are rebuilt
+        self.revisions = dict()
+        # alias -> live index, for aliases which are updated in place
+        self.updated = dict()
+        # alias -> doc id -> content hash, previous and current
+        self.previous = dict()
+        self.hashes = dict()
+        self.mapping_hashes = dict()
+        # alias -> checkpoint of its new index, number of chunks seen and doc ids written
+        self.checkpoints = dict()
+        self.source_hashes = dict()
+        self.chunk_counts = dict()
+        self.doc_ids = dict()
+        # Writes the chunks of every window with ES_BULK_THREADS bulk threads, created once
+        self.pool = None
+
+    def settings_for(self, alias):
+        return dict(self.index_settings, **self.alias_settings.get(alias, dict()))
+
+    def mapping_hash(self, alias, schema):
+        return content_hash(dict(
+            mapping=descriptor_to_mapping(schema, mapping_generator_cls=self.mapper_cls),
+            settings=self.settings_for(alias),
+        ))
+
+    def resumable(self, alias):
+        return settings.ES_RESUMABLE_BULK and self.source_hashes.get(alias) is not None
+
+    def revision(self, alias, schema):
+        if alias not in self.revisions:
+            self.chunk_counts[alias] = 0
+            self.source_hashes[alias] = source_hash(self.sources[alias]) if alias in self.sources else None
+            resumed = self.resumable_index(alias, schema)
+            if resumed is not None:
+                self.revisions[alias] = resumed
+                print('RESUMING', alias, resumed, 'WRITTEN CHUNKS', len(self.checkpoints[alias]['chunks']))
+                return resumed
+            self.revisions[alias] = '{}_{}_{}'.format(alias, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex[:8])
+            # The mapping is created along with the index, as index sorting refers to its fields
+            self.engine.indices.create(self.revisions[alias], body=dict(
+                settings=dict(self.settings_for(alias), **LOADING_SETTINGS),
+                mappings=descriptor_to_mapping(schema, mapping_generator_cls=self.mapper_cls),
+            ))
+            self.checkpoints[alias] = dict(
+                index=self.revisions[alias], mapping_hash=self.mapping_hash(alias, schema),
+                source_hash=self.source_hashes[alias], chunk_size=settings.ES_BULK_CHUNK_SIZE, chunks=[],
+            )
+        return self.revisions[alias]
+
+    def resumable_index(self, alias, schema):
+        """The new index of a failed run, if its checkpoint matches this run (and its sources) and it wasn't swapped in."""
+        checkpoint = load_checkpoint(alias) if self.resumable(alias) else None
+        if checkpoint is None:
+            return None
+        if checkpoint.get('mapping_hash') != self.mapping_hash(alias, schema) or checkpoint.get('chunk_size') != settings.ES_BULK_CHUNK_SIZE:
+            return None
+        if checkpoint.get('source_hash') != self.source_hashes[alias]:
+            print('NOT RESUMING', alias, 'SOURCES CHANGED SINCE', checkpoint['index'])
+            return None
+        index_name = checkpoint['index']
+        if not self.engine.indices.exists(index=index_name):
+            return None
+        if alias in self.engine.indices.get_alias(index=index_name).get(index_name, {}).get('aliases', {}):
+            return None
+        self.checkpoints[alias] = checkpoint
+        return index_name
+
+    def live_index(self, alias, schema):
+        """The index behind the alias, if it can be updated in place according to the alias's manifest."""
+        self.mapping_hashes[alias] = self.mapping_hash(alias, schema)
+        manifest = load_manifest(self.manifests[alias])
+        if manifest is None or not settings.ES_INCREMENTAL_UPSERTS or alias in self.routing:
+            return None
+        descriptor, hashes = manifest
+        if descriptor.get('es_mapping_hash') != self.mapping_hashes[alias]:
+            return None
+        if not self.engine.indices.exists_alias(name=alias) or list(self.engine.indices.get_alias(name=alias)) != [descriptor.get('es_index')]:
+            return None
+        self.previous[alias] = hashes
+        return descriptor['es_index']
+
+    def process_resource(self, resource):
+        res = resource.res
+        if res.name not in self.converted_resources:
+            return resource
+        alias = self.converted_resources[res.name]['index_name']
+        if alias in self.manifests and alias not in self.revisions and alias not in self.updated:
+            self.hashes[alias] = dict()
+            live = self.live_index(alias, res.descriptor['schema'])
+            if live is not None:
+                self.updated[alias] = live
+        if alias in self.updated:
+            return self.write_changes(alias, resource)
+        index_name = self.revision(alias, res.descriptor['schema'])
+        storage = Storage(self.engine)
+        storage.put_mapping(alias, res.descriptor['schema'], index_name, self.mapper_cls)
+        return self.bulk_write(alias, index_name, self.hashing_normalizer(alias, resource), res.schema.primary_key)
+
+    def bulk_write(self, alias, index_name, rows, primary_key):
+        """Index all rows with parallel bulk requests, a chunk per bulk thread at a time, passing them through."""
+        if not primary_key:
+            raise ValueError('primary_key cannot be an empty list')
+        window = []
+        for row in rows:
+            window.append(row)
+            if len(window) >= settings.ES_BULK_CHUNK_SIZE * settings.ES_BULK_THREADS:
+                self.write_window(alias, index_name, window, primary_key)
+                yield from window
+                window = []
+        self.write_window(alias, index_name, window, primary_key)
+        yield from window
+
+    def write_window(self, alias, index_name, docs, primary_key):
+        """Write the chunks of docs which weren't written by a previous run, and checkpoint them once acknowledged."""
+        storage = Storage(self.engine)
+        checkpoint = self.checkpoints[alias]
+        written = checkpoint['chunks']
+        doc_ids = self.doc_ids.setdefault(alias, set())
+        routing = self.routing.get(alias)
+        chunk_size = settings.ES_BULK_CHUNK_SIZE
+        chunks, digests = [], []
+        for start in range(0, len(docs), chunk_size):
+            chunk = docs[start:start + chunk_size]
+            chunk_ids = [storage.generate_doc_id(doc, primary_key) for doc in chunk]
+            doc_ids.update(chunk_ids)
+            position = self.chunk_counts[alias]
+            self.chunk_counts[alias] += 1
+            digest = content_hash([chunk_ids, chunk])
+            if position < len(written) and written[position] == digest:
+                continue
+            chunks.append([
+                dict(
+                    _op_type='index', _index=index_name, _id=doc_id, _source=doc,
+                    **({'_routing': str(doc[routing])} if routing and doc.get(routing) is not None else {})
+                )
+                for doc_id, doc in zip(chunk_ids, chunk)
+            ])
+            digests.append((position, digest))
+        if not chunks:
+            return
+        if settings.ES_BULK_THREADS > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(settings.ES_BULK_THREADS)
+            self.pool.map(self.write_chunk, chunks)
+        else:
+            for actions in chunks:
+                self.write_chunk(actions)
+        for position, digest in digests:
+            if position < len(written):
+                written[position] = digest
+            else:
+                written.append(digest)
+        if self.resumable(alias):
+            save_checkpoint(alias, checkpoint)
+
+    def write_chunk(self, actions):
+        bulk(self.engine, actions, chunk_size=len(actions))
+
+    def hashing_normalizer(self, alias, resource):
+        storage = Storage(self.engine)
+        primary_key = resource.res.schema.primary_key
+        hashes = self.hashes.get(alias)
+        for row in self.normalizer(resource):
+            if hashes is not None:
+                hashes[storage.generate_doc_id(row, primary_key)] = content_hash(row)
+            yield row
+
+    def write_changes(self, alias, resource):
+        """Write only new and changed documents to the live index, passing all rows through."""
+        index_name = self.updated[alias]
+        previous, hashes = self.previous[alias], self.hashes[alias]
+        storage = Storage(self.engine)
+        primary_key = resource.res.schema.primary_key
+        actions = []
+        for row in resource:
+            doc = self.normalize(row)
+            doc_id = storage.generate_doc_id(doc, primary_key)
+            hashes[doc_id] = content_hash(doc)
+            if previous.get(doc_id) != hashes[doc_id]:
+                actions.append(dict(_op_type='index', _index=index_name, _id=doc_id, _source=doc))
+                if len(actions) >= settings.ES_BULK_CHUNK_SIZE:
+                    bulk(self.engine, actions)
+                    actions = []
+            yield row
+        bulk(self.engine, actions)
+
+    def update_in_place(self, alias, index_name):
+        previous, hashes = self.previous[alias], self.hashes[alias]
+        deleted = [doc_id for doc_id in previous if doc_id not in hashes]
+        bulk(self.engine, (dict(_op_type='delete', _index=index_name, _id=doc_id) for doc_id in deleted), ignore_status=(404,))
+        self.engine.indices.refresh(index=index_name)
+        print('UPDATED', alias, index_name, 'ADDED', len(set(hashes) - set(previous)),
+              'CHANGED', sum(1 for doc_id, h in hashes.items() if doc_id in previous and previous[doc_id] != h),
+              'DELETED', len(deleted))
+
+    def previous_indexes(self, alias):
+        """Indexes currently behind the alias, and other indexes of it left over by failed runs."""
+        pattern = re.compile(r'^{}_\d{{20}}_[0-9a-f]{{8}}$'.format(re.escape(alias)))
+        existing = self.engine.indices.get_alias(index='{}_*'.format(alias))
+        current = [name for name, props in existing.items() if alias in props.get('aliases', {})]
+        stale = [name for name in existing if pattern.match(name) and name not in current]
+        return current, [name for name in stale if name != self.revisions[alias]]
+
+    def swap(self, alias, index_name):
+        self.engine.indices.refresh(index=index_name)
+        self.verify(alias, index_name)
+        if self.force_merge:
+            # Before adding the replicas, so that they copy the merged segment rather than merging on their own
+            self.engine.indices.forcemerge(index=index_name, max_num_segments=1)
+        self.engine.indices.put_settings(index=index_name, body=dict(index=dict(
+            refresh_interval=None,
+            number_of_replicas=self.settings_for(alias).get('number_of_replicas', settings.ES_INDEX_REPLICAS),
+        )))
+        current, stale = self.previous_indexes(alias)
+        actions = [dict(add=dict(index=index_name, alias=alias))]
+        actions.extend(dict(remove=dict(index=name, alias=alias)) for name in current)
+        if self.engine.indices.exists(index=alias) and not self.engine.indices.exists_alias(name=alias):
+            # A concrete index named like the alias, from before indexes were versioned
+            actions.append(dict(remove_index=dict(index=alias)))
+        self.engine.indices.update_aliases(body=dict(actions=actions))
+        clear_checkpoint(alias)
+        for name in current + stale:
+            self.engine.indices.delete(index=name, ignore_unavailable=True)
+        print('SWAPPED', alias, '->', index_name, 'DELETED', current + stale)
+
+    def verify(self, alias, index_name):
+        """Check that the new index holds exactly the documents written by this run, before swapping it in."""
+        count = self.engine.count(index=index_name)['count']
+        expected = len(self.doc_ids.get(alias, ()))
+        if count != expected:
+            # Don't resume into this index again
+            clear_checkpoint(alias)
+            raise ValueError('Index {} of {} has {} documents instead of {}'.format(index_name, alias, count, expected))
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def process_resources(self, resources):
+        try:
+            yield from super().process_resources(resources)
+        finally:
+            # Failed runs don't get to finalize
+            self.close_pool()
+
+    def finalize(self):
+        self.close_pool()
+        for alias, index_name in self.updated.items():
+            self.update_in_place(alias, index_name)
+        for alias, index_name in self.revisions.items():
+            self.swap(alias, index_name)
+        for alias in self.hashes:
+            index_name = self.updated.get(alias) or self.revisions[alias]
+            dump_manifest(self.manifests[alias], self.hashes[alias], index_name, self.mapping_hashes[alias])
+        super().finalize()
+
+
+def load_manifest(path):
+    """The package descriptor and the doc id -> content hash dict of a manifest, or None if there is none."""
+    if not os.path.exists(f'{path}/datapackage.json'):
+        return None
+    with open(f'{path}/datapackage.json') as f:
+        descriptor = json.load(f)
+    rows = DF.Flow(load_trusted(f'{path}/datapackage.json')).results()[0][0]
+    return descriptor, dict((row['id'], row['hash']) for row in rows)
+
+
+def dump_manifest(path, hashes, index_name, mapping_hash):
+    dump_rows(
+        (dict(id=doc_id, hash=h) for doc_id, h in hashes.items()), f'{path}.next',
+        'es_manifest', 'Elasticsearch Document Hashes', MANIFEST_FIELDS,
+        es_index=index_name, es_mapping_hash=mapping_hash,
+    )
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(f'{path}.next', path)
+
+
+def source_hash(paths):
+    """A digest of datapackages, whose descriptors hold the hashes of their data files, or None if one is missing."""
+    descriptors = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                descriptors.append(json.load(f))
+        except (OSError, ValueError):
+            return None
+    return content_hash(descriptors)
+
+
+def checkpoint_path(alias):
+    return os.path.join(settings.ES_CHECKPOINT_DIR, f'{alias}.json')
+
+
+def load_checkpoint(alias):
+    try:
+        with open(checkpoint_path(alias)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(alias, checkpoint):
+    path = checkpoint_path(alias)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.next', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'{path}.next', path)
+
+
+def clear_checkpoint(alias):
     try:
-        success = engine.ping()
-        assert success
-    except:
+        os.remove(checkpoint_path(alias))
+    except FileNotFoundError:
+        pass
+
+
+@contextlib.contextmanager
+def dump_override(func):
+    """Within the context, dump_to_es_and_delete returns func(**kwargs) instead of a dumper (e.g. to audit documents offline)."""
+    global _dump_override
+    _dump_override = func
+    try:
+        yield
+    finally:
+        _dump_override = None
+
+
+def dump_to_es_and_delete(**kwargs):
+    """Dump resources to ES through alias swapping, see AliasSwapDumper."""
+    if _dump_override is not None:
+        return _dump_override(**kwargs)
+    if not es_available():
         print('FAILED TO CONNECT TO ES')
         return
-    indexes = list(kwargs.get('indexes').keys())
-    kwargs.setdefault('engine', engine)
+    kwargs.setdefault('engine', es_instance())
     kwargs.setdefault('mapper_cls', SRMMappingGenerator)
-
-    def deleter():
-        time.sleep(30) # wait for ES to settle
-        for index in indexes:
-            response = engine.delete_by_query(index, body=dict(query=dict(bool=dict(must_not=dict(term=dict(revision=unique_id))))), conflicts='proceed')
-            print('DELETED', index, response)
-
-    return DF.Flow(
-        DF.add_field('revision', 'string', unique_id, **{'es:keyword': True}),
-        dump_to_es(**kwargs),
-        DF.delete_fields(['revision']),
-        DF.finalizer(deleter)
-    )
+    return AliasSwapDumper(**kwargs)
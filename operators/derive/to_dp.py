@@ -13,19 +13,29 @@ from srm_tools.stats import Report
 from .autocomplete import IGNORE_SITUATIONS
 from srm_tools.logger import logger
 from srm_tools.unwind import unwind
+from srm_tools.spill import SpillingBuffer, SpillingCounter, SpillingGrouper
+from srm_tools.compact_row import RowPacker
+from srm_tools.fast_load import load_trusted
 from srm_tools.hash import hasher
 from srm_tools.data_cleaning import clean_org_name
 
 from operators.derive import manual_fixes
 
 from . import helpers
-from .autotagging import apply_auto_tagging
+from .autotagging import apply_auto_tagging, load_auto_tagging_rules
+from .changeset import card_changeset
+from .dependencies import plan_derivation
 from .es_schemas import (ADDRESS_PARTS_SCHEMA, NON_INDEXED_ADDRESS_PARTS_SCHEMA, KEYWORD_STRING, KEYWORD_ONLY, ITEM_TYPE_NUMBER, ITEM_TYPE_STRING)
 import sys
 sys.setrecursionlimit(5000) # Increase recursion limit for deep dataflows processing
 
 CHECKPOINT = 'to_dp'
 
+# Grid cell size for branch deduplication, in decimal degrees digits (3 is roughly 100m)
+BRANCH_GRID_PRECISION = 3
+FUZZY_BRANCH_NAME_RATIO = 90
+NON_WORD = re.compile(r'[\W_]+')
+
 
 def count_meser_records():
     """
@@ -234,49 +244,108 @@ def select_address(row, address_fields):
         if helpers.validate_address(v):
             return row[f]
 
+def branch_grid_cell(row):
+    geom = row['branch_geometry']
+    if geom:
+        return '{:.{p}f};{:.{p}f}'.format(*geom, p=BRANCH_GRID_PRECISION)
+    return row['branch_id']
+
+
+def normalize_address(address):
+    return NON_WORD.sub('', address or '')
+
+
 def merge_duplicate_branches(branch_mapping):
-    found = dict()
-    org_count = dict()
+    """Deduplicate branches, bucketed by organization and a coarse location grid cell.
+
+    Within each bucket, branches with the same exact location and name are merged. With DERIVE_FUZZY_BRANCH_MERGE,
+    branches with similar names at the same (normalized) address are merged too.
+    """
+
+    def merge_into(prev_rec, row, ignore=('branch_id', 'branch_key', 'branch_orig_address', 'branch_name')):
+        for k, v in row.items():
+            if k not in ignore:
+                prev_v = prev_rec.get(k)
+                if prev_rec.get(k) != v:
+                    if None in (prev_v, v):
+                        prev_rec[k] = prev_v or v
+                    elif isinstance(v, list):
+                        for ll in v:
+                            if ll not in prev_v:
+                                prev_v.append(ll)
+                    elif isinstance(v, str):
+                        if (ratio := fuzz.ratio(prev_v, v)) < 80:
+                            print('DUPLICATE BRANCH FOR {}, {}: Too different in {} ({} != {} - ratio {})'.format(
+                                row['branch_id'], prev_rec['branch_id'], k, v, prev_rec.get(k), ratio
+                            ))
+                    else:
+                        print('DUPLICATE BRANCH FOR {}, {}: Differs in {} ({} != {})'.format(
+                            row['branch_id'], prev_rec['branch_id'], k, v, prev_rec.get(k)
+                        ))
+
+    def similar_names(rec, row):
+        name, other = rec['branch_name'], row['branch_name']
+        return bool(name and other) and fuzz.ratio(name, other) >= FUZZY_BRANCH_NAME_RATIO
 
     def func(rows):
         count = 0
+        # Rows are retained compactly, and only unpacked one bucket at a time
+        packer = RowPacker()
+        buckets = SpillingGrouper()
         for row in rows:
             count += 1
-
-            geom = row['branch_geometry'] or [row['branch_id']]
-            new_key = hasher(row['organization_id'], ';'.join(map(str, geom)), row['branch_name'])
-            old_key = row['branch_key']
-            branch_mapping[old_key] = new_key
-
-            if new_key in found:
-                prev_rec = found[new_key]
-                for k, v in row.items():
-                    if k not in ('branch_id', 'branch_key', 'branch_orig_address', 'branch_name'):
-                        prev_v = prev_rec.get(k)
-                        if prev_rec.get(k) != v:
-                            if None in (prev_v, v):
-                                prev_rec[k] = prev_v or v
-                            elif isinstance(v, list):
-                                for ll in v:
-                                    if ll not in prev_v:
-                                        prev_v.append(ll)
-                            elif isinstance(v, str):
-                                if (ratio := fuzz.ratio(prev_v, v)) < 80:
-                                    print('DUPLICATE BRANCH FOR {}, {}: Too different in {} ({} != {} - ratio {})'.format(
-                                        row['branch_id'], prev_rec['branch_id'], k, v, prev_rec.get(k), ratio
-                                    ))
-                            else:
-                                print('DUPLICATE BRANCH FOR {}, {}: Differs in {} ({} != {})'.format(
-                                    row['branch_id'], prev_rec['branch_id'], k, v, prev_rec.get(k)
-                                ))
-            else:
-                row['branch_key'] = new_key
-                found[new_key] = row
-                org_count.setdefault(row['organization_id'], 0)
-                org_count[row['organization_id']] += 1
-
-        print('DEDUPLICATION: {} rows, {} unique'.format(count, len(found)))
-        for value in found.values():
+            buckets.add('{};{}'.format(row['organization_id'], branch_grid_cell(row)), packer.pack(row))
+
+        merged = SpillingBuffer()
+        org_count = dict()
+        fuzzy_count = 0
+        for _, bucket in buckets.items():
+            # Exact pass - same organization, location and name
+            found = dict()
+            old_keys = []
+            for row in bucket:
+                row = row.to_dict()
+                geom = row['branch_geometry'] or [row['branch_id']]
+                new_key = hasher(row['organization_id'], ';'.join(map(str, geom)), row['branch_name'])
+                old_keys.append((row['branch_key'], new_key))
+                if new_key in found:
+                    merge_into(found[new_key], row)
+                else:
+                    row['branch_key'] = new_key
+                    found[new_key] = row
+
+            # Fuzzy pass - similar names at the same address, only within this bucket (if enabled)
+            absorbed = dict()
+            by_address = dict()
+            survivors = []
+            for new_key, rec in found.items():
+                address = normalize_address(rec['branch_address'])
+                # Branches without an address can't be told apart by their names alone
+                candidates = by_address.setdefault(address, []) if address and settings.DERIVE_FUZZY_BRANCH_MERGE else []
+                target = next((c for c in candidates if similar_names(c, rec)), None)
+                if target is not None:
+                    print('DUPLICATE BRANCH FOR {}, {}: Similar names at the same address ({} ~ {})'.format(
+                        rec['branch_id'], target['branch_id'], rec['branch_name'], target['branch_name']
+                    ))
+                    merge_into(target, rec, ignore=('branch_id', 'branch_key', 'branch_orig_address', 'branch_name', 'branch_geometry'))
+                    absorbed[new_key] = target['branch_key']
+                    fuzzy_count += 1
+                else:
+                    candidates.append(rec)
+                    org_count.setdefault(rec['organization_id'], 0)
+                    org_count[rec['organization_id']] += 1
+                    survivors.append(rec)
+
+            # Survivors may still absorb later records of the bucket, so only retain them once it's done
+            for rec in survivors:
+                merged.append(packer.pack(rec))
+
+            for old_key, new_key in old_keys:
+                branch_mapping[old_key] = absorbed.get(new_key, new_key)
+
+        print('DEDUPLICATION: {} rows, {} unique ({} merged by similar name)'.format(count, len(merged), fuzzy_count))
+        for value in merged:
+            value = value.to_dict()
             value['organization_branch_count'] = org_count[value['organization_id']]
             yield value
 
@@ -290,7 +359,7 @@ def flat_branches_flow(branch_mapping):
     print('BRANCH MAPPING: branch_key, branch_id, organization_key, branches' )
 
     return DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json',
             resources=['branches', 'locations', 'organizations'],
         ),
@@ -493,11 +562,11 @@ def flat_services_flow(branch_mapping):
         return without_national_branches
 
     return DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/flat_branches/datapackage.json',
             resources=['flat_branches'],
         ),
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json',
             resources=['services'],
         ),
@@ -527,7 +596,7 @@ def flat_services_flow(branch_mapping):
             merge_array_fields(['branches', 'organization_branches']),
             resources=['flat_services'],
         ),
-        unwind('merge_branches', 'branch_key', resources=['flat_services']),
+        unwind('merge_branches', 'branch_key', resources=['flat_services'], copy_on_write=True),
         DF.rename_fields(
             {
                 'key': 'service_key',
@@ -586,11 +655,11 @@ def flat_table_flow():
         return True
 
     return DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/flat_branches/datapackage.json',
             resources=['flat_branches'],
         ),
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/flat_services/datapackage.json',
             resources=['flat_services'],
         ),
@@ -702,23 +771,28 @@ class RSScoreCalc():
     MAX_SCORE = 30
 
     def __init__(self):
-        per_response = DF.Flow(
+        frequencies = SpillingCounter()
+
+        def count_pairs(rows):
+            for row in rows:
+                for situation_id in row['situation_ids'] or []:
+                    for response_id in row['response_ids'] or []:
+                        frequencies.add((situation_id, response_id))
+                yield row
+
+        DF.Flow(
             DF.checkpoint(CHECKPOINT),
             DF.select_fields(['situation_ids', 'response_ids']),
-            unwind('situation_ids', 'situation_id'),
-            unwind('response_ids', 'response_id'),
-            DF.join_with_self('card_data', ['situation_id', 'response_id'], dict(situation_id=None, response_id=None, frequency=dict(aggregate='count'))),
-            DF.add_field('situation_count', 'object', lambda r: dict(situation_id=r['situation_id'], freq=r['frequency']), resources=['card_data']),
-            DF.join_with_self('card_data', ['response_id'], dict(response_id=None, situations=dict(aggregate='array', name='situation_count'))),
-            DF.select_fields(['response_id', 'situations']),
-            # DF.printer()
-        ).results()[0][0]
+            count_pairs,
+        ).process()
 
         self.scores = dict()
-        for r in per_response:
-            total = sum(s['freq'] for s in r['situations'])
-            for s in r['situations']:
-                self.scores[(s['situation_id'], r['response_id'])] = math.log(total / s['freq'])
+        totals = dict()
+        for (situation_id, response_id), freq in frequencies.items():
+            self.scores[(situation_id, response_id)] = freq
+            totals[response_id] = totals.get(response_id, 0) + freq
+        for (situation_id, response_id), freq in self.scores.items():
+            self.scores[(situation_id, response_id)] = math.log(totals[response_id] / freq)
 
 
     def process(self, resources):
@@ -753,10 +827,10 @@ class RSScoreCalc():
         )
 
 
-def card_data_flow():
+def card_data_flow(plan=None, rules=None):
 
     situations = DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json',
             resources=['situations'],
         ),
@@ -768,7 +842,7 @@ def card_data_flow():
         (s['id'], s) for s in situations
     )
     responses = DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json',
             resources=['responses'],
         ),
@@ -792,9 +866,11 @@ def card_data_flow():
     )
 
     DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/flat_table/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/flat_table/datapackage.json'),
         DF.update_package(name='Card Data'),
         DF.update_resource(['flat_table'], name='card_data', path='card_data.csv'),
+        # The flat_* snapshots are always complete, only deriving cards is restricted to the plan's organizations
+        plan.restrict('organization_key', resources=['card_data']) if plan else None,
         DF.add_field(
             'card_id',
             'string',
@@ -808,13 +884,15 @@ def card_data_flow():
         DF.set_type('situation_ids', transform=fix_situations, resources=['card_data']),
         DF.add_field('response_ids', 'array', merge_array_fields(['service_responses']), resources=['card_data']),
         DF.set_type('response_ids', transform=map_taxonomy(responses), resources=['card_data']),
-        apply_auto_tagging(),
+        apply_auto_tagging(rules),
         helpers.get_stats().filter_with_stat(
             'Processing: Cards: No Responses',
             lambda r: bool(r['response_ids']),
             resources=['card_data'],
             report=no_responses_report
         ),
+        plan.splice_retained_cards(resources=['card_data']) if plan else None,
+        plan.store_cards() if plan else None,
         DF.checkpoint(CHECKPOINT),
     ).process()
 
@@ -926,11 +1004,15 @@ def operator(*_):
     shutil.rmtree(f'.checkpoints/srm_raw_airtable_buffer', ignore_errors=True, onerror=None)
 
     branch_mapping = dict()
+    rules = load_auto_tagging_rules()
     srm_data_pull_flow().process()
+    plan = plan_derivation(rules)
     flat_branches_flow(branch_mapping).process()
     flat_services_flow(branch_mapping).process()
     flat_table_flow().process()
-    card_data_flow().process()
+    card_data_flow(plan, rules).process()
+    card_changeset()
+    plan.commit()
 
     logger.info('Finished Data Package Flow')
 
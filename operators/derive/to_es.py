@@ -14,11 +14,70 @@ from . import helpers
 from .es_utils import dump_to_es_and_delete
 
 from srm_tools.logger import logger
-from srm_tools.unwind import unwind
-from .es_schemas import (URL_SCHEMA, TAXONOMY_ITEM_SCHEMA, NON_INDEXED_STRING, KEYWORD_STRING, KEYWORD_ONLY,
-                         ITEM_TYPE_STRING, NO_SCHEMA, LAST_MODIFIED_DATE)
+from srm_tools.count import KeyCounter
+from srm_tools.fast_load import load_trusted
+from srm_tools.fan_out import fan_out
+from srm_tools.geohash import add_geohash_fields
+from srm_tools import hebrew
+from .es_schemas import (URL_SCHEMA, TAXONOMY_ITEM_SCHEMA, NON_INDEXED_STRING, NON_INDEXED_OBJECT, KEYWORD_STRING,
+                         KEYWORD_ONLY, ITEM_TYPE_STRING, NO_SCHEMA, LAST_MODIFIED_DATE, RANK_FEATURE,
+                         AGGREGATE_PROFILE)
 
 CHECKPOINT = 'to_es'
+MIN_RANK_FEATURE = 1.2e-38
+SEARCH_ANALYZER = 'srm_search'
+# Folds queries the same way srm_tools.hebrew.normalize folded search_text
+SEARCH_ANALYSIS = dict(
+    char_filter=dict(
+        srm_niqqud=dict(type='pattern_replace', pattern=f'[{hebrew.NIQQUD}]', replacement=''),
+        srm_acronyms=dict(type='pattern_replace', pattern=hebrew.ACRONYM_RE.pattern, replacement=''),
+        srm_letters=dict(type='mapping', mappings=[
+            f'{letter}=>{folded}' for letter, folded in hebrew.FINAL_LETTERS.items()
+        ] + [f'{hebrew.MAQAF}=>\\u0020']),
+    ),
+    analyzer={
+        SEARCH_ANALYZER: dict(
+            type='custom', char_filter=['srm_niqqud', 'srm_acronyms', 'srm_letters'],
+            tokenizer='standard', filter=['lowercase'],
+        ),
+    },
+)
+# Cards are stored sorted by their static score, so that top cards by score are found without visiting all matches
+CARDS_INDEX_SETTINGS = dict(sort=dict(field='score', order='desc'), analysis=SEARCH_ANALYSIS)
+# Mapping profiles of card fields (by regex), according to how they're queried
+CARD_FIELD_PROFILES = [
+    (r'(response_ids|situation_ids|response_categories|response_category)', AGGREGATE_PROFILE),
+    (r'(organization_id|collapse_key)', AGGREGATE_PROFILE),
+    (r'geohash_\d+', AGGREGATE_PROFILE),
+    # service_id and branch_id keep the default keyword mapping, with doc values, as the API may sort, collapse or
+    # aggregate on them
+]
+# Card texts going into search_text, and their weights
+SEARCH_TEXT_FIELDS = [
+    ('service_name', 3),
+    ('organization_short_name', 2),
+    ('organization_name', 2),
+    ('responses', 2),
+    ('situations', 1),
+    ('branch_name', 1),
+    ('branch_operating_unit', 1),
+    ('branch_city', 1),
+    ('branch_address', 1),
+    ('service_description', 1),
+    ('organization_purpose', 1),
+]
+
+# Card fields which are only shown on the card page, and aren't searched, filtered or sorted by.
+# With ES_CARDS_LEAN these are left out of srm__cards, and full cards are stored in srm__card_details.
+CARD_DETAIL_FIELDS = [
+    'service_key', 'organization_key', 'branch_key',
+    'service_payment_required', 'service_payment_details', 'service_implements', 'service_last_modified',
+    'service_urls', 'service_phone_numbers', 'service_email_address',
+    'organization_description', 'organization_urls', 'organization_phone_numbers', 'organization_email_address',
+    'organization_original_name', 'organization_name_parts',
+    'branch_description', 'branch_urls', 'branch_phone_numbers', 'branch_email_address', 'branch_orig_address',
+    'situations_parents', 'responses_parents', 'data_sources',
+]
 
 
 def card_score(row):
@@ -58,6 +117,12 @@ def card_score(row):
 
     return score
 
+
+def rank_feature(value):
+    # rank_feature fields only accept positive (32 bit normal float) values, other cards don't get the feature
+    return float(value) if value and value >= MIN_RANK_FEATURE else None
+
+
 def parse_date(d):
     if isinstance(d, str):
         try:
@@ -75,13 +140,106 @@ def parse_date(d):
         return None
 
 
-def data_api_es_flow():
+def card_search_text(row):
+    def text(value):
+        if isinstance(value, list):
+            # Taxonomy items, with their names and synonyms
+            return ' '.join(filter(None, (
+                ' '.join(filter(None, [item.get('name')] + (item.get('synonyms') or [])))
+                if isinstance(item, dict) else str(item)
+                for item in value
+            )))
+        return str(value) if value else None
+
+    return hebrew.search_text((text(row.get(field)), weight) for field, weight in SEARCH_TEXT_FIELDS) or None
+
+
+def card_data_source():
+    return load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json')
+
+
+def card_counter():
+    """Counts of cards per response and situation (including their parents) and per organization, by response category."""
+    return KeyCounter(
+        dict(
+            responses=lambda r: helpers.update_taxonomy_with_parents([x['id'] for x in r['responses'] or []]),
+            situations=lambda r: helpers.update_taxonomy_with_parents([x['id'] for x in r['situations'] or []]),
+            organizations=lambda r: r['organization_id'],
+        ),
+        category=lambda r: r['response_category'],
+    )
+
+
+def count_cards():
+    return card_counter().count(load_trusted(
+        f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json',
+        fields=dict(card_data=['responses', 'situations', 'organization_id', 'response_category']),
+    ))
+
+
+def split_card_details():
+    """Move the full cards to a separate card_details resource, keeping only the searched fields in cards."""
+    return DF.Flow(
+        DF.duplicate('cards', 'card_details', 'card_details.csv'),
+        DF.add_field('card', 'object', lambda r: dict(r), resources=['card_details'], **{'es:index': False}),
+        DF.select_fields(['card_id', 'card'], resources=['card_details']),
+        DF.delete_fields(CARD_DETAIL_FIELDS, resources=['cards']),
+    )
+
+
+def canonical_national_services():
+    """Merge the cards of each national service into its highest scored card.
+
+    The canonical card keeps its own fields, with the geometries and card ids of all of the service's branches in
+    branch_geometries and national_card_ids, so searches don't need to collapse the service's branches.
+    Only the cards resource is merged - with ES_CARDS_LEAN, card_details keeps a document per card id, so the
+    details of each of national_card_ids are looked up by that id.
+    """
+    def func(rows):
+        if rows.res.name != 'cards':
+            yield from rows
+            return
+        national = dict()
+        for row in rows:
+            if not row.get('national_service'):
+                yield row
+                continue
+            cards = national.setdefault(row['service_id'], [])
+            cards.append(row)
+        for cards in national.values():
+            canonical = max(cards, key=lambda r: (r['score'] or 0, r['card_id']))
+            geometries = dict()
+            for card in cards:
+                if card.get('branch_geometry'):
+                    point = [float(x) for x in card['branch_geometry']]
+                    geometries.setdefault(tuple(point), point)
+            yield dict(
+                canonical,
+                branch_geometries=list(geometries.values()) or None,
+                national_card_ids=sorted(card['card_id'] for card in cards),
+            )
+
+    return DF.Flow(
+        DF.add_field('branch_geometries', 'array', resources=['cards'], **{'es:itemType': 'geopoint'}),
+        DF.add_field('national_card_ids', 'array', resources=['cards'], **KEYWORD_STRING),
+        func,
+    )
+
+
+def data_api_es_flow(source=None, checkpoint_path='.checkpoints'):
     checkpoint = f'{CHECKPOINT}/data_api_es_flow'
+    indexes = dict(srm__cards=[dict(resource_name='cards')])
+    if settings.ES_CARDS_LEAN:
+        indexes['srm__card_details'] = [dict(resource_name='card_details')]
     DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        source or card_data_source(),
         DF.update_package(title='Card Data', name='srm_card_data'),
         DF.update_resource('card_data', name='cards'),
         DF.add_field('score', 'number', card_score, resources=['cards']),
+        DF.add_field('score_rank', 'number', lambda r: rank_feature(r['score']), resources=['cards'], **RANK_FEATURE),
+        DF.add_field('rs_score_rank', 'number', lambda r: rank_feature(r['rs_score']), resources=['cards'], **RANK_FEATURE),
+        add_geohash_fields('branch_geometry', resources=['cards']),
+        DF.add_field('search_text', 'string', card_search_text, resources=['cards'], **{'es:analyzer': SEARCH_ANALYZER}),
         DF.add_field(
             'airtable_last_modified',
             'datetime',
@@ -110,8 +268,20 @@ def data_api_es_flow():
         DF.set_type('response_ids', **KEYWORD_STRING),
         DF.set_type('situation_ids', **KEYWORD_STRING),
         DF.set_type('airtable_last_modified', **LAST_MODIFIED_DATE),
-        dump_to_es_and_delete(indexes=dict(srm__cards=[dict(resource_name='cards')])),
-        DF.checkpoint(checkpoint),
+        *[DF.set_type(name, resources=['cards'], **profile) for name, profile in CARD_FIELD_PROFILES],
+        split_card_details() if settings.ES_CARDS_LEAN else None,
+        # After splitting the details, which are kept for every card
+        canonical_national_services() if settings.ES_NATIONAL_SERVICE_CANONICAL else None,
+        dump_to_es_and_delete(
+            indexes=indexes,
+            manifests=dict(
+                (index, f"{settings.DATA_DUMP_DIR}/es_{index.replace('srm__', '')}_manifest") for index in indexes
+            ),
+            alias_settings=dict(srm__cards=CARDS_INDEX_SETTINGS),
+            routing=dict(srm__cards='collapse_key') if settings.ES_NATIONAL_SERVICE_CANONICAL else None,
+            sources=dict((index, [f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json']) for index in indexes),
+        ),
+        DF.checkpoint(checkpoint, checkpoint_path=checkpoint_path),
     ).process()
 
     # Not relevant dump to CKAN
@@ -201,38 +371,33 @@ def load_locations_to_es_flow():
             DF.dump_to_path(f'{settings.DATA_DUMP_DIR}/place_data'),
             dump_to_es_and_delete(
                 indexes=dict(srm__places=[dict(resource_name='places')]),
+                force_merge=True,
             ),
             # dump_to_ckan(settings.CKAN_HOST, settings.CKAN_API_KEY, settings.CKAN_OWNER_ORG),
         )
 
 
-def load_responses_to_es_flow():
+def load_responses_to_es_flow(counts=None):
     def print_top(row):
         parts = row['id'].split(':')
         if len(parts) == 2:
             print('STATS', parts[1], row['count'])
 
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
-        DF.add_field('response_ids', 'array', lambda r: [r['id'] for r in r['responses']]),
-        DF.set_type('response_ids', transform=lambda v: helpers.update_taxonomy_with_parents(v)),
-        DF.select_fields(['response_ids']),
-        unwind('response_ids', 'id', 'object'),
-        DF.join_with_self('card_data', ['id'], dict(
-            id=None,
-            count=dict(aggregate='count')
-        )),
+        (counts or count_cards()).resource('responses', 'card_data'),
         load_from_airtable(settings.AIRTABLE_BASE, settings.AIRTABLE_RESPONSE_TABLE, settings.AIRTABLE_VIEW,
                            settings.AIRTABLE_API_KEY),
         DF.update_package(title='Taxonomy Responses', name='responses'),
         DF.update_resource(-1, name='responses'),
         DF.join('card_data', ['id'], 'responses', ['id'], dict(
-            count=None
+            count=None,
+            category_counts=None,
         )),
         DF.filter_rows(lambda r: r.get('status') == 'ACTIVE'),
         DF.filter_rows(lambda r: r['count'] is not None),
-        DF.select_fields(['id', 'name', 'synonyms', 'breadcrumbs', 'count']),
+        DF.select_fields(['id', 'name', 'synonyms', 'breadcrumbs', 'count', 'category_counts']),
         DF.set_type('id', **KEYWORD_ONLY),
+        DF.set_type('category_counts', **NON_INDEXED_OBJECT),
         # DF.set_type('name', **{'es:autocomplete': True}),
         DF.set_type('synonyms', **ITEM_TYPE_STRING),
         DF.add_field('score', 'number', lambda r: r['count']),
@@ -248,33 +413,27 @@ def load_responses_to_es_flow():
     )
 
 
-def load_situations_to_es_flow():
+def load_situations_to_es_flow(counts=None):
     def print_top(row):
         parts = row['id'].split(':')
         if len(parts) == 2:
             print('STATS', parts[1], row['count'])
 
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
-        DF.add_field('situation_ids', 'array', lambda r: [r['id'] for r in r['situations']]),
-        DF.set_type('situation_ids', transform=lambda v: helpers.update_taxonomy_with_parents(v)),
-        DF.select_fields(['situation_ids']),
-        unwind('situation_ids', 'id', 'object'),
-        DF.join_with_self('card_data', ['id'], dict(
-            id=None,
-            count=dict(aggregate='count')
-        )),
+        (counts or count_cards()).resource('situations', 'card_data'),
         load_from_airtable(settings.AIRTABLE_BASE, settings.AIRTABLE_SITUATION_TABLE, settings.AIRTABLE_VIEW,
                            settings.AIRTABLE_API_KEY),
         DF.update_package(title='Taxonomy Situations', name='situations'),
         DF.update_resource(-1, name='situations'),
         DF.join('card_data', ['id'], 'situations', ['id'], dict(
-            count=None
+            count=None,
+            category_counts=None,
         )),
         DF.filter_rows(lambda r: r.get('status') == 'ACTIVE'),
         DF.filter_rows(lambda r: r['count'] is not None),
-        DF.select_fields(['id', 'name', 'synonyms', 'breadcrumbs', 'count']),
+        DF.select_fields(['id', 'name', 'synonyms', 'breadcrumbs', 'count', 'category_counts']),
         DF.set_type('id', **KEYWORD_ONLY),
+        DF.set_type('category_counts', **NON_INDEXED_OBJECT),
         DF.set_type('synonyms', **ITEM_TYPE_STRING),
         DF.add_field('score', 'number', lambda r: r['count']),
         DF.set_primary_key(['id']),
@@ -289,16 +448,13 @@ def load_situations_to_es_flow():
     )
 
 
-def load_organizations_to_es_flow():
+def load_organizations_to_es_flow(counts=None):
     return DF.Flow(
-        DF.load(
+        load_trusted(
             f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json', resources=['organizations'],
+            fields=dict(organizations=['id', 'name', 'description', 'kind']),
         ),
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
-        DF.join_with_self('card_data', ['organization_id'], dict(
-            id=dict(name='organization_id'),
-            count=dict(aggregate='count')
-        )),
+        (counts or count_cards()).resource('organizations', 'card_data'),
         DF.join(
             'organizations', ['id'], 'card_data', ['id'],
             dict(name=None, description=None, kind=None)
@@ -311,10 +467,13 @@ def load_organizations_to_es_flow():
         # DF.set_type('name', **{'es:autocomplete': True}),
         DF.set_type('description', **NO_SCHEMA),
         DF.set_type('kind', **KEYWORD_ONLY),
+        DF.set_type('category_counts', **NON_INDEXED_OBJECT),
         DF.add_field('score', 'number', lambda r: 10 * r['count']),
         DF.set_primary_key(['id']),
         dump_to_es_and_delete(
             indexes=dict(srm__orgs=[dict(resource_name='orgs')]),
+            sources=dict(srm__orgs=[f'{settings.DATA_DUMP_DIR}/srm_data/datapackage.json',
+                                  f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json']),
         ),
         # dump_to_ckan(settings.CKAN_HOST, settings.CKAN_API_KEY, settings.CKAN_OWNER_ORG),
     )
@@ -322,15 +481,17 @@ def load_organizations_to_es_flow():
 
 def load_autocomplete_to_es_flow():
     DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json'),
         DF.update_package(title='AutoComplete Queries', name='autocomplete'),
         DF.set_primary_key(['id']),
         dump_to_es_and_delete(
             indexes=dict(srm__autocomplete=[dict(resource_name='autocomplete')]),
+            force_merge=True,
+            sources=dict(srm__autocomplete=[f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json']),
         ),
     ).process()
     DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json', limit_rows=10000),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json', limit_rows=10000),
         DF.update_package(title='AutoComplete Queries', name='autocomplete'),
         DF.set_primary_key(['id']),
         # dump_to_ckan(settings.CKAN_HOST, settings.CKAN_API_KEY, settings.CKAN_OWNER_ORG),
@@ -341,11 +502,17 @@ def operator(*_):
     shutil.rmtree(f'.checkpoints/{CHECKPOINT}', ignore_errors=True, onerror=None)
 
     logger.info('Starting ES Flow')
-    data_api_es_flow()
+    # Cards are indexed and counted (for responses, situations and organizations) in a single read of card_data
+    counts = card_counter()
+    fan_out(
+        card_data_source(),
+        data_api_es_flow,
+        counts.count,
+    )
     load_locations_to_es_flow().process()
-    load_responses_to_es_flow().process()
-    load_situations_to_es_flow().process()
-    load_organizations_to_es_flow().process()
+    load_responses_to_es_flow(counts).process()
+    load_situations_to_es_flow(counts).process()
+    load_organizations_to_es_flow(counts).process()
     load_autocomplete_to_es_flow()
     logger.info('Finished ES Flow')
 
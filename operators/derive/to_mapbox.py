@@ -16,8 +16,11 @@ from dataflows_ckan import dump_to_ckan
 
 from . import helpers
 from .es_utils import dump_to_es_and_delete
+from .es_schemas import AGGREGATE_PROFILE
 
 from srm_tools.logger import logger
+from srm_tools.fast_load import load_trusted
+from srm_tools.geohash import add_geohash_fields
 
 
 def upload_tileset(filename, tileset, name):
@@ -96,7 +99,7 @@ def preprocess_field(k, v):
 
 def geo_data_flow():
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
         DF.update_package(title='Full Point Data', name='geo_data'),
         DF.update_resource(['card_data'], name='geo_data', path='geo_data.csv'),
         DF.filter_rows(lambda r: r['branch_geometry'] is not None),
@@ -205,7 +208,7 @@ def geo_data_flow():
 
 def points_flow():
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
         DF.update_package(title='Points Data', name='points_data'),
         DF.update_resource(['card_data'], name='points', path='points.csv'),
         DF.set_primary_key(['card_id']),
@@ -224,9 +227,12 @@ def points_flow():
             resources=['points'],
         ),
         DF.add_field('score', 'number', 10, resources=['points']),
+        add_geohash_fields('branch_geometry', resources=['points']),
+        DF.set_type(r'geohash_\d+', resources=['points'], **AGGREGATE_PROFILE),
         # Save mapbox data to ES and CKAN
         dump_to_es_and_delete(
             indexes=dict(srm__points=[dict(resource_name='points')]),
+            sources=dict(srm__points=[f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json']),
         ),
         # dump_to_ckan(
         #     settings.CKAN_HOST,
@@ -7,6 +7,7 @@ from datapackage import Package
 
 from conf import settings
 from srm_tools.logger import logger
+from srm_tools.fast_load import load_trusted
 
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
@@ -40,14 +41,18 @@ def ping_sitemap_for_google():
 
 def data_api_sitemap_flow():
     urls = DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json'),
+        load_trusted(
+            f'{settings.DATA_DUMP_DIR}/autocomplete/datapackage.json',
+            fields=dict(autocomplete=['id', 'visible', 'low', 'score']),
+        ),
         # DF.load(f'{settings.DATA_DUMP_DIR}/place_data/datapackage.json'),
         DF.filter_rows(lambda r: r['visible'] and not r['low'] and r['score'] > 1, resources='autocomplete'),
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json', fields=dict(card_data=['card_id'])),
         DF.add_field('path', 'string', lambda r: '/s/{id}'.format(**r), resources='autocomplete'),
         # DF.add_field('path', 'string', lambda r: '/p/{key}'.format(**r), resources='places'),
         DF.add_field('path', 'string', lambda r: '/c/{card_id}'.format(**r), resources='card_data'),
         DF.set_type('path', transform=lambda v: v.replace("'", '&apos;').replace('"', '&quot;')),
+        DF.select_fields(['path']),
         DF.printer()
     ).results(on_error=None)[0]
     today = datetime.date.today().isoformat()
@@ -2,6 +2,7 @@ import dataflows as DF
 
 from conf import settings
 from srm_tools.logger import logger
+from srm_tools.fast_load import load_trusted
 from srm_tools.processors import update_mapper
 from srm_tools.update_table import airtable_updater
 
@@ -25,7 +26,7 @@ from srm_tools.update_table import airtable_updater
 
 def dump_to_sql_flow():
     return DF.Flow(
-        DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+        load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
         DF.update_resource('card_data', name='cards'),
         DF.dump_to_sql(
             dict(
@@ -113,7 +114,7 @@ def cards_to_at_flow():
         settings.AIRTABLE_CARDS_TABLE, 'card',
         FIELDS, 
         DF.Flow(
-            DF.load(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
+            load_trusted(f'{settings.DATA_DUMP_DIR}/card_data/datapackage.json'),
             DF.add_field('data', 'object', lambda r: dict((k, r.get(k)) for k in FIELDS), resources=-1),
             DF.add_field('id', 'string', lambda r: r.get('card_id'), resources=-1),
             DF.select_fields(['id', 'data'], resources=-1),
@@ -8,6 +8,7 @@ import elasticsearch
 from elasticsearch.helpers import scan
 import os
 from extract.extract_data_from_airtable import load_airtable_as_dataframe  # Adjust import path as needed
+from srm_tools import diff
 
 class Settings:
     ES_HOST = "srm-production-elasticsearch.whiletrue.industries"
@@ -69,9 +70,9 @@ def find_active_cards_index():
     return selected_index
 
 
-def get_elasticsearch_dataframe(index_name, id_field='id'):
+def elasticsearch_rows(index_name, id_field='id'):
     """
-    Fetches all documents from an ES index and returns them as a DataFrame.
+    Streams all documents of an ES index as dicts.
     """
     client = es_instance()
     print(f"--- Fetching all records from Elasticsearch index: {index_name} ---")
@@ -79,55 +80,34 @@ def get_elasticsearch_dataframe(index_name, id_field='id'):
     # Use scan to retrieve all documents (bypasses the 10k limit)
     query = {"query": {"match_all": {}}}
 
-    cursor = scan(client, query=query, index=index_name)
-
-    data = []
-    for doc in cursor:
-        source = doc.get('_source', {})
-        record = source
+    count = 0
+    for doc in scan(client, query=query, index=index_name):
+        record = doc.get('_source', {})
         # Ensure we capture the ID.
         if id_field not in record:
             record[id_field] = doc['_id']
-        data.append(record)
-
-    df = pd.DataFrame(data)
-    print(f"--- Fetched {len(df)} records from Elasticsearch ---")
-    return df
+        count += 1
+        yield record
+    print(f"--- Fetched {count} records from Elasticsearch ---")
 
 
-def compare_datasets(airtable_df, es_df, id_col='id'):
+def compare_datasets(airtable_rows, es_rows, id_col='id'):
     """
-    Compares two dataframes on a specific ID column and returns 3 split dataframes.
+    Compares two streams of records on a specific ID column.
+    Returns a summary of the discrepancies, and the records found only in Airtable and only in ES.
     """
-    # 1. Normalize IDs to strings to ensure matching works
-    airtable_df[id_col] = airtable_df[id_col].astype(str).str.strip()
-    es_df[id_col] = es_df[id_col].astype(str).str.strip()
-
-    # 2. Identify Sets
-    airtable_ids = set(airtable_df[id_col])
-    es_ids = set(es_df[id_col])
-
-    common_ids = airtable_ids.intersection(es_ids)
-    only_airtable_ids = airtable_ids - es_ids
-    only_es_ids = es_ids - airtable_ids
-
-    # 3. Create DataFrames
-    # A. Intersection (ID exists in both)
-    df_common = pd.merge(
-        airtable_df[airtable_df[id_col].isin(common_ids)],
-        es_df[es_df[id_col].isin(common_ids)],
-        on=id_col,
-        how='inner',
-        suffixes=('_airtable', '_es')
-    )
-
-    # B. Airtable Only
-    df_airtable_only = airtable_df[airtable_df[id_col].isin(only_airtable_ids)].copy()
+    airtable_only, es_only = [], []
 
-    # C. Elasticsearch Only
-    df_es_only = es_df[es_df[id_col].isin(only_es_ids)].copy()
+    def collect(discrepancies):
+        for discrepancy in discrepancies:
+            if discrepancy['kind'] == diff.ONLY_LEFT:
+                airtable_only.append(dict(discrepancy['row'], **{id_col: discrepancy['key']}))
+            elif discrepancy['kind'] == diff.ONLY_RIGHT:
+                es_only.append(dict(discrepancy['row'], **{id_col: discrepancy['key']}))
+            yield discrepancy
 
-    return df_common, df_airtable_only, df_es_only
+    summary = diff.report(collect(diff.diff(airtable_rows, es_rows, key=id_col)))
+    return summary, pd.DataFrame(airtable_only), pd.DataFrame(es_only)
 
 
 if __name__ == "__main__":
@@ -157,33 +137,29 @@ if __name__ == "__main__":
             print(f"Failed to load Airtable data: {e}")
             cards_airtable_df = pd.DataFrame(columns=[ID_COLUMN])
 
-        # 3. Load Elasticsearch Data
-        print("\nLoading Elasticsearch Data...")
-        try:
-            cards_es_df = get_elasticsearch_dataframe(index_name=ES_INDEX, id_field=ID_COLUMN)
-        except Exception as e:
-            print(f"Failed to load ES data: {e}")
-            cards_es_df = pd.DataFrame(columns=[ID_COLUMN])
-
-        # 4. Perform Comparison
-        if not cards_airtable_df.empty and not cards_es_df.empty:
-            df_both, df_at_only, df_es_only = compare_datasets(
-                cards_airtable_df,
-                cards_es_df,
-                id_col=ID_COLUMN
-            )
-
-            # 5. Report Results
-            print("\n" + "=" * 30)
-            print(" COMPARISON RESULTS ")
-            print("=" * 30)
-            print(f"1. IDs in BOTH: {len(df_both)}")
-            print(f"2. IDs in Airtable ONLY (Missing in ES): {len(df_at_only)}")
-            print(f"3. IDs in Elastic ONLY (Ghosts/Zombies): {len(df_es_only)}")
-
-            # Save results if needed
-            df_es_only.to_csv('ghosts_in_es.csv', index=False)
-            df_at_only.to_csv('missing_in_es.csv', index=False)
-            print("\nDetailed reports saved as 'ghosts_in_es.csv' and 'missing_in_es.csv'.")
+        # 3. Compare with the Elasticsearch Data
+        print("\nComparing with Elasticsearch Data...")
+        if not cards_airtable_df.empty:
+            try:
+                summary, df_at_only, df_es_only = compare_datasets(
+                    cards_airtable_df.to_dict('records'),
+                    elasticsearch_rows(index_name=ES_INDEX, id_field=ID_COLUMN),
+                    id_col=ID_COLUMN
+                )
+            except Exception as e:
+                print(f"Failed to load ES data: {e}")
+                summary = None
+
+            # 4. Report Results
+            if summary is not None:
+                print("\n" + "=" * 30)
+                print(" COMPARISON RESULTS ")
+                print("=" * 30)
+                print(diff.format_report(summary, 'airtable', 'es'))
+
+                # Save results if needed
+                df_es_only.to_csv('ghosts_in_es.csv', index=False)
+                df_at_only.to_csv('missing_in_es.csv', index=False)
+                print("\nDetailed reports saved as 'ghosts_in_es.csv' and 'missing_in_es.csv'.")
         else:
-            print("One or both dataframes are empty. Cannot perform comparison.")
+            print("Airtable data is empty. Cannot perform comparison.")
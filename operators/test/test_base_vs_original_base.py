@@ -1,6 +1,7 @@
 import pandas as pd
 from conf import settings
 from load.airtable import get_airtable_table
+from srm_tools import diff
 from srm_tools.logger import logger
 
 
@@ -87,94 +88,41 @@ def compare_and_export_differences(dict_of_matching_tables: dict):
             logger.info(f"Skipping comparison for {table_name}: 'id' column missing.")
             continue
 
-        # Set index to 'id' for easy lookup
-        # drop_duplicates prevents errors if data has duplicate IDs
-        df_orig = df_orig.drop_duplicates(subset=['id']).set_index('id')
-        df_test = df_test.drop_duplicates(subset=['id']).set_index('id')
-
-        ids_orig = set(df_orig.index)
-        ids_test = set(df_test.index)
-
-        # --- STEP 1: Handle Unmatching Records ---
-        only_in_orig = ids_orig - ids_test
-        only_in_test = ids_test - ids_orig
-
+        # Group both sides by id in one pass - only the first record of a duplicate id is compared
         unmatching_records = []
-
-        # Process records Only in Original
-        if only_in_orig:
-            # Select rows, reset index to get 'id' back as column
-            df_unmatch_orig = df_orig.loc[list(only_in_orig)].reset_index()
-            df_unmatch_orig['mismatch_type'] = 'Only in Original'
-            unmatching_records.append(df_unmatch_orig)
-
-        # Process records Only in Test
-        if only_in_test:
-            df_unmatch_test = df_test.loc[list(only_in_test)].reset_index()
-            df_unmatch_test['mismatch_type'] = 'Only in Test'
-            unmatching_records.append(df_unmatch_test)
+        field_differences = []
+        for discrepancy in diff.diff(df_orig.to_dict('records'), df_test.to_dict('records'), key='id'):
+            kind = discrepancy['kind']
+            if kind == diff.DUPLICATE:
+                continue
+
+            # --- Unmatching Records ---
+            if kind in (diff.ONLY_LEFT, diff.ONLY_RIGHT):
+                unmatching_records.append(dict(
+                    id=discrepancy['key'],
+                    mismatch_type='Only in Original' if kind == diff.ONLY_LEFT else 'Only in Test',
+                    **discrepancy['row']
+                ))
+
+            # --- Field Differences in Common Records ---
+            else:
+                field_differences.append({
+                    "id": discrepancy['key'],
+                    "type": "Field Difference",
+                    "field": discrepancy['field'],
+                    "original_value": discrepancy['left'],
+                    "test_value": discrepancy['right']
+                })
 
         # Export Unmatching CSV
         if unmatching_records:
-            df_unmatching = pd.concat(unmatching_records, ignore_index=True)
-
-            # Reorder columns to put 'id' and 'mismatch_type' at the start
-            cols = ['id', 'mismatch_type'] + [c for c in df_unmatching.columns if c not in ['id', 'mismatch_type']]
-            df_unmatching = df_unmatching[cols]
-
+            df_unmatching = pd.DataFrame(unmatching_records)
             unmatch_filename = f"{table_name.replace(' ', '_')}_unmatching_records.csv"
             df_unmatching.to_csv(unmatch_filename, index=False, encoding='utf-8-sig')
             logger.info(f"-> Found {len(df_unmatching)} unmatching records. Exported to {unmatch_filename}")
         else:
             logger.info(f"-> All records match by ID (no unmatching records).")
 
-        # --- STEP 2: Compare Fields for Common Records ---
-        common_ids = ids_orig.intersection(ids_test)
-        field_differences = []
-
-        if common_ids:
-            # Create subsets of only common IDs for faster iteration
-            df_orig_common = df_orig.loc[list(common_ids)]
-            df_test_common = df_test.loc[list(common_ids)]
-
-            common_columns = set(df_orig.columns).intersection(set(df_test.columns))
-
-            for uid in common_ids:
-                row_orig = df_orig_common.loc[uid]
-                row_test = df_test_common.loc[uid]
-
-                for col in common_columns:
-                    val_orig = row_orig[col]
-                    val_test = row_test[col]
-
-                    is_diff = False
-
-                    # 1. Handle Lists (Airtable Linked Records/Multi-selects)
-                    if isinstance(val_orig, list) or isinstance(val_test, list):
-                        if type(val_orig) != type(val_test):
-                            is_diff = True
-                        else:
-                            # Both are lists. Compare directly.
-                            is_diff = val_orig != val_test
-
-                    # 2. Handle Scalars
-                    else:
-                        if pd.isna(val_orig) and pd.isna(val_test):
-                            is_diff = False
-                        elif pd.isna(val_orig) != pd.isna(val_test):
-                            is_diff = True
-                        elif val_orig != val_test:
-                            is_diff = True
-
-                    if is_diff:
-                        field_differences.append({
-                            "id": uid,
-                            "type": "Field Difference",
-                            "field": col,
-                            "original_value": val_orig,
-                            "test_value": val_test
-                        })
-
         # Export Differences CSV
         if field_differences:
             diff_filename = f"{table_name.replace(' ', '_')}_differences.csv"
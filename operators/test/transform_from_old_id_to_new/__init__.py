@@ -9,22 +9,35 @@ from load.airtable import update_if_exists_if_not_create, update_airtable_record
 from utilities.update import prepare_airtable_dataframe
 
 
+def copy_values_from_old_ids(airtable_df: pd.DataFrame, new_ids: pd.Series, old_ids: pd.Series, fields_to_copy: list):
+    """Copy fields from the record of each old id to the record of its new id, marking the new records as changed.
+
+    Lookups go through id -> value maps, instead of scanning the tables for every record.
+    """
+    airtable_df = airtable_df.copy()
+    old_id_by_new_id = dict()
+    for new_id, old_id in zip(new_ids, old_ids):
+        # First match wins, as with .values[0]
+        old_id_by_new_id.setdefault(new_id, old_id)
+    records_by_id = airtable_df.drop_duplicates(subset=['id']).set_index('id')
+    changed = airtable_df['id'].isin(old_id_by_new_id.keys())
+    old_ids_of_changed = airtable_df.loc[changed, 'id'].map(old_id_by_new_id)
+    for field in fields_to_copy:
+        if field in airtable_df.columns:
+            airtable_df.loc[changed, field] = old_ids_of_changed.map(records_by_id[field].to_dict())
+    airtable_df['isChanged'] = changed
+    return airtable_df
+
+
 def fix_services_data(services_df: pd.DataFrame):
     services_airtable_df = load_airtable_as_dataframe(
         table_name=settings.AIRTABLE_SERVICE_TABLE,
         base_id=settings.AIRTABLE_STAGING_BASE
     )
-    services_airtable_df['isChanged'] = False
     fields_to_copy = ['Cards']
-    def copy_values(row):
-        if row['id'] in services_df['new_service_id'].values:
-            airtable_new_id = services_df.loc[services_df['new_service_id'] == row['id'], 'old_service_id'].values[0]
-            for field in fields_to_copy:
-                if field in services_airtable_df.columns:
-                    row[field] = services_airtable_df.loc[services_airtable_df['id'] == airtable_new_id, field].values[0]
-            row['isChanged'] = True
-        return row
-    services_airtable_df = services_airtable_df.apply(copy_values, axis=1)
+    services_airtable_df = copy_values_from_old_ids(
+        services_airtable_df, services_df['new_service_id'], services_df['old_service_id'], fields_to_copy
+    )
     services_airtable_df = services_airtable_df[services_airtable_df['isChanged']]
     prepared_services_df = prepare_airtable_dataframe(df=services_airtable_df, key_field="id", airtable_key="id", fields_to_prepare=fields_to_copy)
     prepared_services_df = prepared_services_df.where(pd.notnull(prepared_services_df), None)
@@ -43,17 +56,10 @@ def fix_branches_data(branches_df: pd.DataFrame):
         table_name=settings.AIRTABLE_BRANCH_TABLE,
         base_id=settings.AIRTABLE_STAGING_BASE
     )
-    branches_airtable_df['isChanged'] = False
     fields_to_copy = ['Cards']
-    def copy_values(row):
-        if row['id'] in branches_df['new_branch_id'].values:
-            airtable_new_id = branches_df.loc[branches_df['new_branch_id'] == row['id'], 'old_branch_id'].values[0]
-            for field in fields_to_copy:
-                if field in branches_airtable_df.columns:
-                    row[field] = branches_airtable_df.loc[branches_airtable_df['id'] == airtable_new_id, field].values[0]
-            row['isChanged'] = True
-        return row
-    branches_airtable_df = branches_airtable_df.apply(copy_values, axis=1)
+    branches_airtable_df = copy_values_from_old_ids(
+        branches_airtable_df, branches_df['new_branch_id'], branches_df['old_branch_id'], fields_to_copy
+    )
     branches_airtable_df = branches_airtable_df[branches_airtable_df['isChanged']]
     prepared_branches_df = prepare_airtable_dataframe(df=branches_airtable_df, key_field="id", airtable_key="id", fields_to_prepare=fields_to_copy)
     prepared_branches_df = prepared_branches_df.where(pd.notnull(prepared_branches_df), None)
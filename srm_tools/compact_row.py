@@ -0,0 +1,95 @@
+from collections.abc import Mapping
+
+# Fields with more distinct values than this are not interned
+MAX_INTERNED_VALUES = 10000
+
+# Field indexes by id, so that pickled rows (e.g. when spilled to disk) only carry the id
+_INDEXES = []
+_INDEX_IDS = dict()
+
+
+class FieldIndex():
+    """Field names of a schema, shared by all the compact rows having that schema."""
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        self.id = len(_INDEXES)
+
+    @staticmethod
+    def get(names):
+        names = tuple(names)
+        if names not in _INDEX_IDS:
+            index = FieldIndex(names)
+            _INDEXES.append(index)
+            _INDEX_IDS[names] = index.id
+        return _INDEXES[_INDEX_IDS[names]]
+
+
+def _restore(index_id, values):
+    return CompactRow(_INDEXES[index_id], values)
+
+
+class CompactRow(Mapping):
+    """A read-only, dict compatible row, made of a shared field index and a tuple of values."""
+
+    __slots__ = ('index', 'values')
+
+    def __init__(self, index, values):
+        self.index = index
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.index.positions[key]]
+
+    def __contains__(self, key):
+        return key in self.index.positions
+
+    def __iter__(self):
+        return iter(self.index.names)
+
+    def __len__(self):
+        return len(self.values)
+
+    def to_dict(self):
+        return dict(zip(self.index.names, self.values))
+
+    def __reduce__(self):
+        return _restore, (self.index.id, self.values)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class RowPacker():
+    """Packs dict rows into compact rows, interning repeating string values per field.
+
+    Strings (and strings in lists of strings) are interned as long as the field has at most
+    max_interned distinct values, after which the field is no longer interned.
+    """
+
+    def __init__(self, max_interned=MAX_INTERNED_VALUES):
+        self.max_interned = max_interned
+        self.interned = dict()
+
+    def intern(self, field, value):
+        if isinstance(value, list):
+            if value and all(isinstance(v, str) for v in value):
+                return [self.intern(field, v) for v in value]
+            return value
+        if not isinstance(value, str):
+            return value
+        table = self.interned.setdefault(field, dict())
+        if table is None:
+            return value
+        ret = table.get(value)
+        if ret is None:
+            if len(table) >= self.max_interned:
+                self.interned[field] = None
+                return value
+            table[value] = ret = value
+        return ret
+
+    def pack(self, row):
+        index = FieldIndex.get(row.keys())
+        return CompactRow(index, tuple(self.intern(k, v) for k, v in row.items()))
@@ -0,0 +1,65 @@
+import dataflows as DF
+
+from srm_tools.spill import SpillingCounter
+
+# Categories are stored alongside their key in the counters, so a missing category must still be comparable
+NO_CATEGORY = ''
+
+
+class KeyCounter():
+    """Counts rows by several keys at once, in a single pass, with a breakdown of each count by a category.
+
+    keys - a dict of name -> function of a row, returning the keys (a key or a list of keys) the row is
+    counted for, e.g. dict(organizations=lambda row: row['organization_id']).
+    category - a function of a row returning its category.
+
+    Rows are counted by passing them through counting(), or with count(). Counts are kept in memory,
+    spilling to disk beyond budget_mb (DERIVE_MEMORY_BUDGET_MB by default).
+    """
+
+    def __init__(self, keys, category=None, budget_mb=None):
+        self.keys = keys
+        self.category = category
+        self.counters = dict((name, SpillingCounter(budget_mb)) for name in keys)
+
+    def counting(self):
+        """A rows processor counting the rows passing through it."""
+        counters = [(self.counters[name], func) for name, func in self.keys.items()]
+
+        def func(rows):
+            for row in rows:
+                category = (self.category(row) if self.category else None) or NO_CATEGORY
+                for counter, keys_func in counters:
+                    keys = keys_func(row)
+                    for key in keys if isinstance(keys, (list, tuple, set)) else [keys]:
+                        if key is not None:
+                            counter.add((key, category))
+                yield row
+        return func
+
+    def count(self, source):
+        """Count all rows of the source steps."""
+        DF.Flow(source, self.counting()).process()
+        return self
+
+    def counts(self, name):
+        """Rows of id, count and category_counts (a dict of category -> count) of the given counter."""
+        ret = dict()
+        for (key, category), count in self.counters[name].items():
+            row = ret.setdefault(key, dict(id=key, count=0, category_counts=dict()))
+            row['count'] += count
+            if category != NO_CATEGORY:
+                row['category_counts'][category] = count
+        return ret.values()
+
+    def resource(self, name, resource_name):
+        """A step loading the counts of the given counter as a resource."""
+        descriptor = dict(resources=[dict(
+            name=resource_name, path=f'{resource_name}.csv',
+            schema=dict(fields=[
+                dict(name='id', type='string'),
+                dict(name='count', type='integer'),
+                dict(name='category_counts', type='object'),
+            ]),
+        )])
+        return DF.load((descriptor, [iter(self.counts(name))]))
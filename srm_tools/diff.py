@@ -0,0 +1,118 @@
+import decimal
+import numbers
+
+from srm_tools.spill import SpillingGrouper
+
+LEFT = 0
+RIGHT = 1
+
+ONLY_LEFT = 'only_left'
+ONLY_RIGHT = 'only_right'
+DUPLICATE = 'duplicate'
+DIFFERENT = 'different'
+
+EXAMPLES = 5
+
+
+def normalize(value, unordered=False):
+    """Normalize a field value for comparison.
+
+    Empty values (None, NaN, empty or whitespace-only strings, empty lists and dicts) are None, strings are stripped,
+    integral numbers are ints whatever their type, and lists and dicts are normalized recursively.
+    With unordered, lists are compared regardless of the order of their items.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.strip() or None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (numbers.Number, decimal.Decimal)):
+        if value != value:
+            return None
+        value = float(value) if not isinstance(value, numbers.Integral) else int(value)
+        return int(value) if isinstance(value, float) and value.is_integer() else value
+    if isinstance(value, dict):
+        value = dict((k, normalize(v, unordered)) for k, v in value.items())
+        return dict((k, v) for k, v in value.items() if v is not None) or None
+    if isinstance(value, (list, tuple, set)):
+        items = [normalize(v, unordered) for v in value]
+        if unordered or isinstance(value, set):
+            items = sorted(items, key=repr)
+        return items or None
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return normalize(value.item(), unordered)
+    return value
+
+
+def keyed_rows(rows, key, fields=None, side=LEFT, unordered=()):
+    for row in rows:
+        row_key = normalize(row.get(key))
+        if row_key is None:
+            continue
+        names = fields if fields is not None else [name for name in row.keys() if name != key]
+        yield str(row_key), (side, dict(
+            (name, normalize(row.get(name), name in unordered)) for name in names
+        ))
+
+
+def diff(left, right, key, fields=None, right_key=None, unordered=(), budget_mb=None):
+    """Compare two streams of rows (dicts) by key, yielding a discrepancy dict for every difference.
+
+    Rows are grouped by key as they stream in, in memory or in sorted runs on disk once the memory budget
+    (DERIVE_MEMORY_BUDGET_MB by default) is exceeded, so both sides are read once and in any order.
+
+    fields - the fields to compare, defaults to the fields which the rows of both sides have in common.
+    right_key - the key field of the right side, if it's named differently.
+    unordered - fields holding lists whose order doesn't matter.
+
+    Discrepancies have a `kind` - ONLY_LEFT / ONLY_RIGHT (with the `row`), DUPLICATE (a key appearing more than
+    once on one side - only its first row is compared) or DIFFERENT (a `field` with `left` and `right` values).
+    """
+    grouper = SpillingGrouper(budget_mb)
+    unordered = set(unordered)
+    for side, rows, side_key in ((LEFT, left, key), (RIGHT, right, right_key or key)):
+        for row_key, value in keyed_rows(rows, side_key, fields, side, unordered):
+            grouper.add(row_key, value)
+
+    for row_key, values in grouper.items():
+        sides = ([], [])
+        for side, row in values:
+            sides[side].append(row)
+        for side, rows in enumerate(sides):
+            if len(rows) > 1:
+                yield dict(key=row_key, kind=DUPLICATE, side='left' if side == LEFT else 'right', count=len(rows))
+        left_rows, right_rows = sides
+        if not right_rows:
+            yield dict(key=row_key, kind=ONLY_LEFT, row=left_rows[0])
+        elif not left_rows:
+            yield dict(key=row_key, kind=ONLY_RIGHT, row=right_rows[0])
+        else:
+            left_row, right_row = left_rows[0], right_rows[0]
+            names = fields if fields is not None else [name for name in left_row if name in right_row]
+            for name in names:
+                if left_row.get(name) != right_row.get(name):
+                    yield dict(key=row_key, kind=DIFFERENT, field=name, left=left_row.get(name), right=right_row.get(name))
+
+
+def report(discrepancies, examples=EXAMPLES):
+    """A compact summary of discrepancies - counts per kind and per differing field, with a few example keys each."""
+    ret = dict(((kind, dict(count=0, examples=[])) for kind in (ONLY_LEFT, ONLY_RIGHT, DUPLICATE)), fields=dict())
+    for discrepancy in discrepancies:
+        kind = discrepancy['kind']
+        entry = ret['fields'].setdefault(discrepancy['field'], dict(count=0, examples=[])) if kind == DIFFERENT else ret[kind]
+        entry['count'] += 1
+        if len(entry['examples']) < examples:
+            entry['examples'].append(discrepancy['key'])
+    return ret
+
+
+def format_report(summary, left_name='left', right_name='right'):
+    names = {ONLY_LEFT: 'only in {}'.format(left_name), ONLY_RIGHT: 'only in {}'.format(right_name), DUPLICATE: 'duplicate keys'}
+    lines = []
+    for kind, name in names.items():
+        lines.append('{}: {} {}'.format(name, summary[kind]['count'], summary[kind]['examples'] or ''))
+    for field, entry in sorted(summary['fields'].items(), key=lambda x: -x[1]['count']):
+        lines.append('field {}: {} differences {}'.format(field, entry['count'], entry['examples']))
+    return '\n'.join(lines)
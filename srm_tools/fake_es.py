@@ -0,0 +1,470 @@
+"""A local stand-in for Elasticsearch, for measuring the ES export without a cluster.
+
+Implements the subset of the REST API used by our ES sinks: ping, index create / delete / exists, put mapping and
+settings, aliases, _bulk, _delete_by_query, _count, a match_all / ids _search, refresh, flush, force merge and _cat/indices.
+Documents are kept in memory and persisted to a data directory on flush, refresh and shutdown. Every request is
+recorded with its (compressed and raw) payload size, the number of bulk actions and its handling time - see
+FakeES.stats, or GET /_fake/stats.
+
+Run it with `python -m srm_tools.fake_es --port 9200`, and point ES_HOST / ES_PORT at it.
+Or in process (before the ES client is first created):
+
+    with FakeES(data_dir) as es:
+        settings.ES_HOST, settings.ES_PORT = es.host, es.port
+        ...
+"""
+import os
+import re
+import gzip
+import json
+import time
+import fnmatch
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+VERSION = '7.13.4'
+
+
+class ESError(Exception):
+
+    def __init__(self, status, type_, reason):
+        super().__init__(reason)
+        self.status = status
+        self.type = type_
+        self.reason = reason
+
+    def body(self):
+        return dict(error=dict(type=self.type, reason=self.reason, root_cause=[dict(type=self.type, reason=self.reason)]), status=self.status)
+
+
+def not_found(index):
+    return ESError(404, 'index_not_found_exception', 'no such index [{}]'.format(index))
+
+
+class Index():
+
+    def __init__(self, name, settings=None, mappings=None, aliases=None, docs=None):
+        self.name = name
+        self.settings = settings or dict()
+        self.mappings = mappings or dict(properties=dict())
+        self.aliases = set(aliases or ())
+        self.docs = docs if docs is not None else dict()
+
+    def meta(self):
+        return dict(settings=self.settings, mappings=self.mappings, aliases=sorted(self.aliases))
+
+
+class Store():
+    """Indexes and aliases, persisted to a directory with a meta.json and a docs.jsonl per index."""
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir
+        self.indexes = dict()
+        self.lock = threading.RLock()
+        if data_dir and os.path.isdir(data_dir):
+            for name in os.listdir(data_dir):
+                meta_path = os.path.join(data_dir, name, 'meta.json')
+                if not os.path.exists(meta_path):
+                    continue
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                docs = dict()
+                with open(os.path.join(data_dir, name, 'docs.jsonl')) as f:
+                    for line in f:
+                        doc = json.loads(line)
+                        docs[doc['_id']] = doc['_source']
+                self.indexes[name] = Index(name, docs=docs, **meta)
+
+    def persist(self, names=None):
+        if not self.data_dir:
+            return
+        with self.lock:
+            names = list(self.indexes) if names is None else [name for name in names if name in self.indexes]
+            for name in names:
+                index = self.indexes[name]
+                path = os.path.join(self.data_dir, name)
+                os.makedirs(path, exist_ok=True)
+                with open(os.path.join(path, 'meta.json'), 'w') as f:
+                    json.dump(index.meta(), f)
+                with open(os.path.join(path, 'docs.jsonl'), 'w') as f:
+                    for doc_id, source in index.docs.items():
+                        f.write(json.dumps(dict(_id=doc_id, _source=source), ensure_ascii=False) + '\n')
+
+    def remove(self, name):
+        if self.data_dir:
+            path = os.path.join(self.data_dir, name)
+            for filename in ('meta.json', 'docs.jsonl'):
+                if os.path.exists(os.path.join(path, filename)):
+                    os.unlink(os.path.join(path, filename))
+            if os.path.isdir(path):
+                os.rmdir(path)
+
+    def resolve(self, expression, must_exist=True):
+        """Index names matching a comma separated list of names, aliases and wildcards."""
+        ret = []
+        for part in expression.split(','):
+            if part in ('_all', '*'):
+                matched = list(self.indexes)
+            elif '*' in part:
+                matched = [name for name in self.indexes if fnmatch.fnmatchcase(name, part)]
+            elif part in self.indexes:
+                matched = [part]
+            else:
+                matched = [name for name, index in self.indexes.items() if part in index.aliases]
+                if not matched and must_exist:
+                    raise not_found(part)
+            ret.extend(name for name in matched if name not in ret)
+        return ret
+
+
+def matches(query, doc_id, source):
+    """Evaluate the few query types we use."""
+    if not query or 'match_all' in query:
+        return True
+    if 'ids' in query:
+        return doc_id in query['ids'].get('values', [])
+    if 'term' in query or 'terms' in query:
+        field, value = next(iter((query.get('term') or query['terms']).items()))
+        if isinstance(value, dict):
+            value = value.get('value')
+        values = value if isinstance(value, list) else [value]
+        actual = source.get(field)
+        actual = actual if isinstance(actual, list) else [actual]
+        return any(v in actual for v in values)
+    if 'bool' in query:
+        clauses = query['bool']
+
+        def listed(key):
+            value = clauses.get(key, [])
+            return value if isinstance(value, list) else [value]
+
+        return (
+            all(matches(q, doc_id, source) for q in listed('must') + listed('filter'))
+            and not any(matches(q, doc_id, source) for q in listed('must_not'))
+            and (not listed('should') or any(matches(q, doc_id, source) for q in listed('should')))
+        )
+    raise ESError(400, 'parsing_exception', 'unsupported query {}'.format(list(query)))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        size = len(raw)
+        if raw and self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return raw, size
+
+    def reply(self, status, body=None):
+        data = json.dumps(body if body is not None else dict(), ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('X-elastic-product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(data) if self.command != 'HEAD' else 0))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def handle_request(self):
+        start = time.time()
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        raw, size = self.read_body()
+        actions = 0
+        try:
+            with self.store.lock:
+                status, body, actions = self.route(self.command, parts, params, raw)
+        except ESError as e:
+            status, body = e.status, e.body()
+        self.reply(status, body)
+        self.server.record(dict(
+            method=self.command, path=url.path, status=status, request_bytes=size, raw_bytes=len(raw),
+            actions=actions, duration=time.time() - start,
+        ))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+    def json_body(self, raw):
+        return json.loads(raw) if raw.strip() else dict()
+
+    def route(self, method, parts, params, raw):
+        if not parts:
+            return 200, dict(name='fake-es', cluster_name='fake-es', version=dict(number=VERSION), tagline='You Know, for Search'), 0
+        if parts == ['_fake', 'stats']:
+            return 200, self.server.summary(), 0
+        if parts[-1] == '_bulk':
+            return self.bulk(parts[0] if len(parts) == 2 else None, raw, params)
+        if parts == ['_aliases'] and method == 'POST':
+            return self.update_aliases(self.json_body(raw))
+        if parts[0] == '_alias' or (parts[0] == '_aliases' and method == 'GET'):
+            return self.get_alias(None, parts[1] if len(parts) > 1 else None, method)
+        if parts[:2] == ['_cat', 'indices']:
+            return 200, [
+                {'index': name, 'docs.count': str(len(index.docs)), 'health': 'green', 'status': 'open'}
+                for name, index in sorted(self.store.indexes.items())
+            ], 0
+        if parts[0] in ('_refresh', '_flush', '_forcemerge'):
+            self.store.persist()
+            return 200, dict(_shards=dict(total=1, successful=1, failed=0)), 0
+        if parts[0].startswith('_'):
+            raise ESError(400, 'invalid_index_name_exception', 'unsupported endpoint {}'.format('/'.join(parts)))
+
+        expression, rest = parts[0], parts[1:]
+        if not rest:
+            if method == 'HEAD':
+                return (200 if self.store.resolve(expression, must_exist=False) else 404), None, 0
+            if method == 'PUT':
+                return self.create(expression, self.json_body(raw))
+            if method == 'DELETE':
+                for name in self.store.resolve(expression):
+                    del self.store.indexes[name]
+                    self.store.remove(name)
+                return 200, dict(acknowledged=True), 0
+            if method == 'GET':
+                return 200, dict((name, self.store.indexes[name].meta()) for name in self.store.resolve(expression)), 0
+        endpoint = rest[0]
+        if endpoint in ('_alias', '_aliases'):
+            if method == 'PUT':
+                for name in self.store.resolve(expression):
+                    self.store.indexes[name].aliases.add(rest[1])
+                return 200, dict(acknowledged=True), 0
+            return self.get_alias(expression, rest[1] if len(rest) > 1 else None, method)
+        names = self.store.resolve(expression)
+        if endpoint == '_mapping':
+            if method in ('PUT', 'POST'):
+                mapping = self.json_body(raw)
+                for name in names:
+                    self.store.indexes[name].mappings.setdefault('properties', dict()).update(mapping.get('properties', dict()))
+                return 200, dict(acknowledged=True), 0
+            return 200, dict((name, dict(mappings=self.store.indexes[name].mappings)) for name in names), 0
+        if endpoint == '_settings':
+            if method in ('PUT', 'POST'):
+                update = self.json_body(raw)
+                update = update.get('index', update)
+                for name in names:
+                    self.store.indexes[name].settings.setdefault('index', dict()).update(update)
+                return 200, dict(acknowledged=True), 0
+            return 200, dict((name, dict(settings=self.store.indexes[name].settings)) for name in names), 0
+        if endpoint in ('_refresh', '_flush', '_forcemerge'):
+            self.store.persist(names)
+            return 200, dict(_shards=dict(total=len(names), successful=len(names), failed=0)), 0
+        if endpoint == '_count':
+            query = self.json_body(raw).get('query')
+            count = sum(
+                1 for name in names for doc_id, source in self.store.indexes[name].docs.items()
+                if matches(query, doc_id, source)
+            )
+            return 200, dict(count=count, _shards=dict(total=len(names), successful=len(names), failed=0)), 0
+        if endpoint == '_search':
+            return self.search(names, self.json_body(raw), params)
+        if endpoint == '_delete_by_query':
+            query = self.json_body(raw).get('query')
+            deleted = 0
+            for name in names:
+                docs = self.store.indexes[name].docs
+                for doc_id in [doc_id for doc_id, source in docs.items() if matches(query, doc_id, source)]:
+                    del docs[doc_id]
+                    deleted += 1
+            return 200, dict(took=0, timed_out=False, total=deleted, deleted=deleted, failures=[]), 0
+        if endpoint == '_doc' and len(rest) == 2:
+            if len(names) != 1:
+                raise not_found(expression)
+            docs = self.store.indexes[names[0]].docs
+            if method in ('PUT', 'POST'):
+                created = rest[1] not in docs
+                docs[rest[1]] = self.json_body(raw)
+                return (201 if created else 200), dict(_index=names[0], _id=rest[1], result='created' if created else 'updated'), 0
+            if rest[1] not in docs:
+                return 404, dict(_index=names[0], _id=rest[1], found=False), 0
+            if method == 'DELETE':
+                del docs[rest[1]]
+                return 200, dict(_index=names[0], _id=rest[1], result='deleted'), 0
+            return 200, dict(_index=names[0], _id=rest[1], found=True, _source=docs[rest[1]]), 0
+        raise ESError(400, 'illegal_argument_exception', 'unsupported endpoint {}'.format('/'.join(parts)))
+
+    def create(self, name, body):
+        if name in self.store.indexes:
+            raise ESError(400, 'resource_already_exists_exception', 'index [{}] already exists'.format(name))
+        self.store.indexes[name] = Index(
+            name, settings=body.get('settings'), mappings=body.get('mappings'), aliases=body.get('aliases', dict()).keys()
+        )
+        return 200, dict(acknowledged=True, shards_acknowledged=True, index=name), 0
+
+    def get_alias(self, expression, alias, method):
+        names = self.store.resolve(expression) if expression else list(self.store.indexes)
+        ret = dict()
+        for name in names:
+            aliases = self.store.indexes[name].aliases
+            if alias is not None:
+                aliases = [a for a in aliases if any(fnmatch.fnmatchcase(a, p) for p in alias.split(','))]
+                if not aliases:
+                    continue
+            ret[name] = dict(aliases=dict((a, dict()) for a in sorted(aliases)))
+        if alias is not None and not ret:
+            return 404, dict(error='alias [{}] missing'.format(alias), status=404), 0
+        return 200, ret, 0
+
+    def update_aliases(self, body):
+        # Validate everything first, so that the update is applied atomically
+        actions = []
+        for action in body.get('actions', []):
+            (kind, spec), = action.items()
+            names = self.store.resolve(spec.get('index') or ','.join(spec.get('indices', [])))
+            actions.append((kind, names, spec))
+        for kind, names, spec in actions:
+            for name in names:
+                if kind == 'add':
+                    self.store.indexes[name].aliases.add(spec['alias'])
+                elif kind == 'remove':
+                    self.store.indexes[name].aliases.discard(spec['alias'])
+                elif kind == 'remove_index':
+                    del self.store.indexes[name]
+                    self.store.remove(name)
+        return 200, dict(acknowledged=True), 0
+
+    def search(self, names, body, params):
+        query = body.get('query')
+        start = int(body.get('from', params.get('from', 0)))
+        size = int(body.get('size', params.get('size', 10)))
+        hits = [
+            dict(_index=name, _id=doc_id, _score=1.0, _source=source)
+            for name in names
+            for doc_id, source in self.store.indexes[name].docs.items()
+            if matches(query, doc_id, source)
+        ]
+        return 200, dict(
+            took=0, timed_out=False, _shards=dict(total=len(names), successful=len(names), failed=0),
+            hits=dict(total=dict(value=len(hits), relation='eq'), max_score=1.0, hits=hits[start:start + size]),
+        ), 0
+
+    def bulk(self, default_index, raw, params):
+        lines = iter(line for line in raw.decode('utf-8').split('\n') if line.strip())
+        items = []
+        errors = False
+        for line in lines:
+            (op, meta), = json.loads(line).items()
+            source = json.loads(next(lines)) if op in ('index', 'create', 'update') else None
+            name = meta.get('_index', default_index)
+            doc_id = meta.get('_id') or os.urandom(10).hex()
+            names = self.store.resolve(name, must_exist=False)
+            if not names:
+                # Like ES, writing to a missing index creates it
+                self.store.indexes[name] = Index(name)
+                names = [name]
+            docs = self.store.indexes[names[0]].docs
+            item = dict(_index=names[0], _id=doc_id)
+            if op == 'delete':
+                found = docs.pop(doc_id, None) is not None
+                item.update(status=200 if found else 404, result='deleted' if found else 'not_found')
+            elif op == 'create' and doc_id in docs:
+                errors = True
+                item.update(status=409, error=dict(type='version_conflict_engine_exception', reason='document already exists'))
+            elif op == 'update':
+                if doc_id in docs:
+                    docs[doc_id] = dict(docs[doc_id], **source.get('doc', dict()))
+                    item.update(status=200, result='updated')
+                elif source.get('doc_as_upsert') or 'upsert' in source:
+                    docs[doc_id] = source.get('upsert') or source.get('doc')
+                    item.update(status=201, result='created')
+                else:
+                    errors = True
+                    item.update(status=404, error=dict(type='document_missing_exception', reason='document missing'))
+            else:
+                created = doc_id not in docs
+                docs[doc_id] = source
+                item.update(status=201 if created else 200, result='created' if created else 'updated')
+            items.append({op: item})
+        if params.get('refresh') in ('true', 'wait_for', ''):
+            self.store.persist()
+        return 200, dict(took=0, errors=errors, items=items), len(items)
+
+
+class FakeES():
+    """A fake ES server running in a background thread. Port 0 picks a free port."""
+
+    def __init__(self, data_dir=None, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.store = Store(data_dir)
+        self.server.requests = []
+        self.server.record = self.record
+        self.server.summary = self.summary
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def store(self):
+        return self.server.store
+
+    @property
+    def stats(self):
+        return list(self.server.requests)
+
+    def record(self, request):
+        self.server.requests.append(request)
+
+    def summary(self):
+        """Request counts, payload sizes and handling times, per method and endpoint."""
+        ret = dict()
+        for request in self.server.requests:
+            endpoint = re.sub(r'^/[^_/][^/]*', '/{index}', request['path'])
+            key = '{} {}'.format(request['method'], endpoint)
+            rec = ret.setdefault(key, dict(requests=0, request_bytes=0, raw_bytes=0, actions=0, duration=0.0))
+            for k in ('request_bytes', 'raw_bytes', 'actions', 'duration'):
+                rec[k] += request[k]
+            rec['requests'] += 1
+        return ret
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-es', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.persist()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake Elasticsearch server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--data-dir', default='.fake_es')
+    args = parser.parse_args()
+    es = FakeES(args.data_dir, args.host, args.port)
+    print('Fake ES listening on {}:{}, storing to {}'.format(es.host, es.port, args.data_dir))
+    try:
+        es.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        es.server.server_close()
+        es.store.persist()
+        print(json.dumps(es.summary(), indent=2))
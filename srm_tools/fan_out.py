@@ -0,0 +1,79 @@
+import copy
+import queue
+import threading
+
+import dataflows as DF
+
+from srm_tools.logger import logger
+
+QUEUE_SIZE = 1000
+# Marks the end of a resource's rows
+END = object()
+# Marks a failure of the source, failing the sinks instead of letting them complete with partial rows
+ABORT = object()
+
+
+def _put(q, thread, item):
+    # A sink which stopped reading (or failed) would otherwise block the source forever
+    while thread.is_alive():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def _rows(q):
+    while True:
+        row = q.get()
+        if row is END:
+            return
+        if row is ABORT:
+            raise RuntimeError('The source of the fan out failed')
+        yield row
+
+
+def fan_out(source, *sinks, queue_size=QUEUE_SIZE):
+    """Read the source steps once, and feed every row to several sinks running side by side.
+
+    Each sink is a callable which gets a step producing the source's datapackage, and runs its flow
+    to completion. Each sink runs in its own thread, reading from a bounded queue, and gets its own
+    shallow copy of every row.
+    """
+    ds = DF.Flow(source).datastream()
+    descriptor = ds.dp.descriptor
+    num_resources = len(descriptor['resources'])
+    queues = [queue.Queue(maxsize=queue_size) for _ in sinks]
+    errors = []
+
+    def run(sink, q):
+        try:
+            sink(DF.load((copy.deepcopy(descriptor), [_rows(q) for _ in range(num_resources)])))
+        except Exception as e:
+            logger.exception('Sink %r failed', sink)
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=run, args=(sink, q), name='fan-out-{}'.format(i), daemon=True)
+        for i, (sink, q) in enumerate(zip(sinks, queues))
+    ]
+    for thread in threads:
+        thread.start()
+    completed = False
+    try:
+        for res in ds.res_iter:
+            for row in res:
+                for q, thread in zip(queues, threads):
+                    _put(q, thread, dict(row))
+            for q, thread in zip(queues, threads):
+                _put(q, thread, END)
+        completed = True
+    finally:
+        # Sinks still waiting for rows would otherwise block forever, the source's error is raised after they fail
+        if not completed:
+            for q, thread in zip(queues, threads):
+                _put(q, thread, ABORT)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
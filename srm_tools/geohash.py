@@ -0,0 +1,58 @@
+import dataflows as DF
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Cell sizes from ~39x20km (4) down to ~150x150m (7), for map zoom levels of about 6 to 15
+PRECISIONS = (4, 5, 6, 7)
+
+
+def encode(lat, lon, precision=max(PRECISIONS)):
+    """The geohash of a point - each shorter prefix of it is the geohash of the containing, coarser cell."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    ret = []
+    even = True
+    ch = bit = 0
+    while len(ret) < precision:
+        value, bounds = (lon, lon_range) if even else (lat, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        ch <<= 1
+        if value >= mid:
+            ch |= 1
+            bounds[0] = mid
+        else:
+            bounds[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            ret.append(BASE32[ch])
+            ch = bit = 0
+    return ''.join(ret)
+
+
+def field_name(precision):
+    return f'geohash_{precision}'
+
+
+def add_geohash_fields(geometry_field, resources=None, precisions=PRECISIONS):
+    """Add a keyword field per precision with the geohash cell of a [lon, lat] geometry field.
+
+    Map viewport counts and clusters then become terms aggregations over these cells.
+    """
+    cache = dict()
+
+    def cells(row):
+        point = row.get(geometry_field)
+        if not point:
+            return None
+        lon, lat = float(point[0]), float(point[1])
+        if (lon, lat) not in cache:
+            cache[(lon, lat)] = encode(lat, lon, max(precisions))
+        return cache[(lon, lat)]
+
+    return DF.Flow(*[
+        DF.add_field(
+            field_name(precision), 'string',
+            lambda row, precision=precision: (cells(row) or '')[:precision] or None,
+            resources=resources, **{'es:keyword': True},
+        )
+        for precision in precisions
+    ])
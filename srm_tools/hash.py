@@ -1,6 +1,20 @@
+import decimal
 import hashlib
+import json
 
 
 def hasher(*args):
     return hashlib.sha1(''.join(filter(None, args)).encode('utf-8')).hexdigest()[:8]
 
+
+def _json_default(obj):
+    # Numbers may come back as Decimal after a dump/load round trip, so hash them as floats
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def content_hash(obj):
+    """Stable hash of a JSON-able object (e.g. a row), independent of key order."""
+    data = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=_json_default)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
@@ -0,0 +1,57 @@
+import re
+
+# Cantillation marks and niqqud (but not maqaf, paseq and sof pasuq, which are punctuation)
+NIQQUD = '\u0591-\u05bd\u05bf\u05c1\u05c2\u05c4\u05c5\u05c7'
+MAQAF = '\u05be'
+FINAL_LETTERS = dict(zip('ךםןףץ', 'כמנפצ'))
+# Geresh and gershayim, and the quotes typed instead of them
+QUOTES = '\'"\u05f3\u05f4'
+# One letter prefixes (ו, ה, ב, כ, ל, מ, ש) which are written attached to the word
+PREFIXES = 'והבכלמש'
+MAX_PREFIX = 2
+MIN_STEM = 3
+
+NIQQUD_RE = re.compile(f'[{NIQQUD}]')
+# Quotes inside a word are part of an acronym (צה"ל) or a transliteration (ג'ירפה), and are dropped
+ACRONYM_RE = re.compile(f'(?<=[א-ת])[{QUOTES}]+(?=[א-ת])')
+TOKEN_RE = re.compile(r'\w+')
+FINALS_TABLE = str.maketrans(FINAL_LETTERS)
+
+
+def normalize(text):
+    """Fold Hebrew text for matching - without niqqud, acronym quotes and final letter forms, and lower cased."""
+    if not text:
+        return ''
+    text = NIQQUD_RE.sub('', text).replace(MAQAF, ' ')
+    text = ACRONYM_RE.sub('', text)
+    return text.translate(FINALS_TABLE).lower()
+
+
+def tokens(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def stems(token):
+    """The token without up to MAX_PREFIX attached prefixes, as long as at least MIN_STEM letters are left."""
+    ret = []
+    for i in range(1, MAX_PREFIX + 1):
+        if len(token) - i < MIN_STEM or token[i - 1] not in PREFIXES:
+            break
+        ret.append(token[i:])
+    return ret
+
+
+def search_text(parts):
+    """A single normalized text for full text search, from (text, weight) parts.
+
+    Weights are applied by repeating a part's tokens, raising their term frequency. The tokens' variants
+    without prefixes are added once, so that 'לנוער' is also found by 'נוער' without outweighing exact matches.
+    """
+    ret = []
+    for text, weight in parts:
+        if not text:
+            continue
+        words = tokens(text)
+        ret.extend(words * weight)
+        ret.extend(stem for token in words for stem in stems(token))
+    return ' '.join(ret)
@@ -0,0 +1,170 @@
+import os
+import heapq
+import pickle
+import tempfile
+from itertools import chain, groupby
+from operator import itemgetter
+
+from conf import settings
+
+# Python objects take a few times more memory than their pickled form
+PYTHON_OVERHEAD = 4
+SAMPLE_EVERY = 1000
+MAX_OPEN_RUNS = 64
+
+
+def memory_budget(budget_mb=None):
+    budget_mb = settings.DERIVE_MEMORY_BUDGET_MB if budget_mb is None else budget_mb
+    return int(budget_mb * 1024 * 1024) if budget_mb else None
+
+
+class SpillBase():
+    """Base class for accumulators which spill sorted runs to disk once a memory budget is exceeded.
+
+    Without a budget (the default) everything is kept in memory and insertion order is preserved.
+    Once spilled, items come back ordered by key, so keys must be mutually comparable.
+    """
+
+    def __init__(self, budget_mb=None):
+        self.budget = memory_budget(budget_mb)
+        self.runs = []
+        self.run_count = 0
+        self.tmpdir = None
+        self.in_memory = 0
+        self.seen = 0
+        self.item_size = None
+
+    def over_budget(self, item):
+        if not self.budget:
+            return False
+        self.in_memory += 1
+        self.seen += 1
+        if self.item_size is None or self.seen % SAMPLE_EVERY == 0:
+            size = len(pickle.dumps(item, pickle.HIGHEST_PROTOCOL)) * PYTHON_OVERHEAD
+            self.item_size = size if self.item_size is None else (self.item_size + size) / 2
+        return self.in_memory * self.item_size > self.budget
+
+    def write_run(self, items):
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.TemporaryDirectory(prefix='srm-spill-', dir=settings.DERIVE_SPILL_DIR)
+        path = os.path.join(self.tmpdir.name, 'run-{:05d}'.format(self.run_count))
+        self.run_count += 1
+        with open(path, 'wb') as f:
+            for item in items:
+                pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(path)
+        self.in_memory = 0
+        if len(self.runs) >= MAX_OPEN_RUNS:
+            runs, self.runs = self.runs, []
+            self.write_run(self.compact_runs(runs))
+            for path in runs:
+                os.unlink(path)
+
+    @staticmethod
+    def read_run(path):
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+
+    def merge_runs(self, runs):
+        # heapq.merge is stable, so items from earlier runs come out first for equal keys
+        return heapq.merge(*(self.read_run(path) for path in runs), key=itemgetter(0))
+
+    def compact_runs(self, runs):
+        return self.merge_runs(runs)
+
+    def close(self):
+        if self.tmpdir is not None:
+            self.tmpdir.cleanup()
+            self.tmpdir = None
+        self.runs = []
+
+
+class SpillingCounter(SpillBase):
+    """Counts occurrences of keys."""
+
+    def __init__(self, budget_mb=None):
+        super().__init__(budget_mb)
+        self.counts = dict()
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        else:
+            self.counts[key] = count
+            if self.over_budget((key, count)):
+                self.spill()
+
+    def spill(self):
+        self.write_run(sorted(self.counts.items(), key=itemgetter(0)))
+        self.counts = dict()
+
+    def items(self):
+        if not self.runs:
+            yield from self.counts.items()
+            return
+        self.spill()
+        for key, group in groupby(self.merge_runs(self.runs), key=itemgetter(0)):
+            yield key, sum(count for _, count in group)
+        self.close()
+
+
+class SpillingGrouper(SpillBase):
+    """Collects values into groups by key, keeping the order of values within each group."""
+
+    def __init__(self, budget_mb=None):
+        super().__init__(budget_mb)
+        self.groups = dict()
+
+    def add(self, key, value):
+        self.groups.setdefault(key, []).append(value)
+        if self.over_budget((key, value)):
+            self.spill()
+
+    def spill(self):
+        self.write_run(
+            (key, value)
+            for key in sorted(self.groups.keys())
+            for value in self.groups[key]
+        )
+        self.groups = dict()
+
+    def items(self):
+        if not self.runs:
+            yield from self.groups.items()
+            return
+        self.spill()
+        for key, group in groupby(self.merge_runs(self.runs), key=itemgetter(0)):
+            yield key, [value for _, value in group]
+        self.close()
+
+
+class SpillingBuffer(SpillBase):
+    """An append-only list which is read back once, in insertion order."""
+
+    def __init__(self, budget_mb=None):
+        super().__init__(budget_mb)
+        self.pending = []
+        self.length = 0
+
+    def append(self, item):
+        self.pending.append(item)
+        self.length += 1
+        if self.over_budget(item):
+            self.write_run(self.pending)
+            self.pending = []
+
+    def compact_runs(self, runs):
+        return chain.from_iterable(self.read_run(path) for path in runs)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for path in self.runs:
+            yield from self.read_run(path)
+        yield from self.pending
+        self.close()
@@ -1,14 +1,97 @@
+from collections.abc import MutableMapping
+
 from dataflows.helpers import ResourceMatcher
 
 
+class OverlayRow(MutableMapping):
+    """A row sharing all fields of a base row, except for a single overridden (and optionally a hidden) field.
+
+    Reads go through to the base row, so no copy is made unless the row is mutated -
+    in which case it is materialized into a dict of its own first. Key order is the same as for
+    a dict copy of the base row with the field set on it.
+    """
+
+    __slots__ = ('_base', '_key', '_value', '_hidden', '_data')
+
+    def __init__(self, base, key, value, hidden=None):
+        self._base = base
+        self._key = key
+        self._value = value
+        self._hidden = hidden if hidden != key else None
+        self._data = None
+
+    def __getitem__(self, key):
+        if self._data is not None:
+            return self._data[key]
+        if key == self._key:
+            return self._value
+        if key == self._hidden:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __contains__(self, key):
+        if self._data is not None:
+            return key in self._data
+        return key == self._key or (key != self._hidden and key in self._base)
+
+    def __iter__(self):
+        if self._data is not None:
+            yield from self._data
+            return
+        for key in self._base:
+            if key != self._hidden:
+                yield key
+        if self._key not in self._base:
+            yield self._key
+
+    def __len__(self):
+        if self._data is not None:
+            return len(self._data)
+        return len(self._base) + (self._key not in self._base) - (self._hidden is not None and self._hidden in self._base)
+
+    def materialize(self):
+        if self._data is None:
+            self._data = dict(self.items())
+            self._base = None
+        return self._data
+
+    def __setitem__(self, key, value):
+        self.materialize()[key] = value
+
+    def __delitem__(self, key):
+        del self.materialize()[key]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
 def unwind(
     from_key, to_key, to_key_type='string',
-    transformer=None, resources=None, source_delete=True, allow_empty=None
+    transformer=None, resources=None, source_delete=True, allow_empty=None,
+    copy_on_write=False
 ):
 
-    """From a row of data, generate a row per value from from_key, where the value is set onto to_key."""
+    """From a row of data, generate a row per value from from_key, where the value is set onto to_key.
+
+    With copy_on_write, generated rows are OverlayRow views over the original row, which are only copied if mutated.
+    These are not dicts, so use it only when the following steps read the rows or build new ones from them
+    (e.g. select_fields, rename_fields or a join_with_self) rather than serializing them as is.
+    """
     from dataflows.processors.add_computed_field import get_new_fields
 
+    def _make_row(row, value):
+        if copy_on_write and from_key != to_key:
+            return OverlayRow(row, to_key, value, from_key if source_delete is True else None)
+        ret = {}
+        ret.update(row)
+        ret[to_key] = value
+        if source_delete is True:
+            del ret[from_key]
+        return ret
+
     def _unwinder(rows):
         for row in rows:
             try:
@@ -17,20 +100,10 @@ def unwind(
                 if allow_empty and len(values) == 0:
                     values = [None]
                 for value in values:
-                    ret = {}
-                    ret.update(row)
-                    ret[to_key] = value
-                    if source_delete is True:
-                        del ret[from_key]
-                    yield ret
+                    yield _make_row(row, value)
             except TypeError:
                 # no iterable to unwind. Take the value we have and set it on the to_key.
-                ret = {}
-                ret.update(row)
-                ret[to_key] = ret[from_key] if transformer is None else transformer(ret[from_key])
-                if source_delete is True:
-                    del ret[from_key]
-                yield ret
+                yield _make_row(row, row[from_key] if transformer is None else transformer(row[from_key]))
 
     def func(package):
         matcher = ResourceMatcher(resources, package.pkg)
@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+# conf.settings requires these, but none of the tests reach the services they configure
+REQUIRED_ENV = dict(
+    ETL_GUIDESTAR_USERNAME='test', ETL_GUIDESTAR_PASSWORD='test', ETL_GOVMAP_API_KEY='test',
+    ETL_AIRTABLE_ALTERNATE_BASE='test', ETL_AIRTABLE_DATAENTRY_BASE='test', ETL_AIRTABLE_DATA_IMPORT_BASE='test',
+    DATAFLOWS_AIRTABLE_APIKEY='test', ETL_MAPBOX_ACCESS_TOKEN='test', ETL_GOOGLE_MAPS_API_KEY='test',
+    ENV_NAME='test', ES_HOST='localhost', ES_PORT='9200',
+    CKAN_HOST='test', CKAN_API_KEY='test', CKAN_OWNER_ORG='test',
+    EMAIL_NOTIFIER_SENDER_EMAIL='test', EMAIL_NOTIFIER_PASSWORD='test', EMAIL_NOTIFIER_RECIPIENT_LIST='test@example.com',
+)
+for name, value in REQUIRED_ENV.items():
+    os.environ.setdefault(name, value)
+
+
+@pytest.fixture
+def es(tmp_path, monkeypatch):
+    """A fake ES server, which the ES flows of the test connect to."""
+    # Only once the environment is set
+    from conf import settings
+    from operators.derive import es_utils
+    from srm_tools.fake_es import FakeES
+
+    with FakeES() as es:
+        monkeypatch.setattr(settings, 'ES_HOST', es.host)
+        monkeypatch.setattr(settings, 'ES_PORT', es.port)
+        monkeypatch.setattr(settings, 'ES_CHECKPOINT_DIR', str(tmp_path / 'checkpoints'))
+        monkeypatch.setattr(settings, 'ES_RESUMABLE_BULK', True)
+        monkeypatch.setattr(settings, 'ES_BULK_CHUNK_SIZE', 10)
+        monkeypatch.setattr(settings, 'ES_BULK_THREADS', 2)
+        # A client of this server
+        monkeypatch.setattr(es_utils, '_client', None)
+        monkeypatch.setattr(es_utils, '_client_available', False)
+        yield es
@@ -0,0 +1,112 @@
+import json
+import threading
+
+import pytest
+import dataflows as DF
+
+from conf import settings
+from operators.derive import es_utils
+
+ALIAS = 'srm__items'
+ROWS = 95
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source' / 'datapackage.json'
+    path.parent.mkdir()
+
+    def write(version):
+        path.write_text(json.dumps(dict(name='source', hash=version)))
+        return [str(path)]
+    return write
+
+
+def failing(fail_at):
+    # Fails while the rows are being dumped, unlike a failure of the loaded rows, which fails inferring their schema
+    def func(rows):
+        for i, row in enumerate(rows):
+            if i == fail_at:
+                raise ValueError('failed')
+            yield row
+    return func
+
+
+def dump(sources, fail_at=None, **kwargs):
+    DF.Flow(
+        [dict(id=str(i), name='item {}'.format(i)) for i in range(ROWS)],
+        DF.update_resource(-1, name='items'),
+        DF.set_primary_key(['id']),
+        failing(fail_at),
+        es_utils.dump_to_es_and_delete(indexes={ALIAS: [dict(resource_name='items')]}, sources=sources and {ALIAS: sources},
+                                       **kwargs),
+    ).process()
+
+
+def written(es):
+    return sum(request['actions'] for request in es.stats if request['path'].endswith('_bulk'))
+
+
+def indexes(es):
+    return dict((name, index) for name, index in es.store.indexes.items() if name.startswith(ALIAS + '_'))
+
+
+def test_resumes_a_failed_dump(es, source):
+    sources = source('v1')
+    with pytest.raises(Exception):
+        dump(sources, fail_at=50)
+    failed, = indexes(es)
+    assert not indexes(es)[failed].aliases
+    # Two windows of two chunks were written before the failure
+    before = written(es)
+    assert before == 40
+
+    dump(sources)
+    assert list(indexes(es)) == [failed]
+    assert indexes(es)[failed].aliases == {ALIAS}
+    assert len(indexes(es)[failed].docs) == ROWS
+    # Only the chunks which weren't acknowledged by the failed run are written
+    assert written(es) - before == ROWS - 40
+
+
+def test_changed_sources_are_dumped_from_scratch(es, source):
+    with pytest.raises(Exception):
+        dump(source('v1'), fail_at=50)
+    failed, = indexes(es)
+    before = written(es)
+
+    dump(source('v2'))
+    current, = indexes(es)
+    assert current != failed
+    assert indexes(es)[current].aliases == {ALIAS}
+    assert len(indexes(es)[current].docs) == ROWS
+    assert written(es) - before == ROWS
+
+
+def test_dumps_without_sources_are_not_resumed(es):
+    with pytest.raises(Exception):
+        dump(None, fail_at=50)
+    failed, = indexes(es)
+    dump(None)
+    current, = indexes(es)
+    assert current != failed
+
+
+def test_force_merge_before_adding_replicas(es):
+    dump(None, force_merge=True)
+    current, = indexes(es)
+    requests = [(request['method'], request['path']) for request in es.stats if request['path'].startswith('/' + current)]
+    merged = requests.index(('POST', '/{}/_forcemerge'.format(current)))
+    settings_updated = requests.index(('PUT', '/{}/_settings'.format(current)))
+    assert merged < settings_updated
+
+
+def pool_threads():
+    return [thread for thread in threading.enumerate() if thread.name.endswith('(worker)')]
+
+
+def test_failed_dumps_close_the_bulk_threads(es):
+    threads = pool_threads()
+    with pytest.raises(Exception):
+        dump(None, fail_at=50)
+    assert pool_threads() == threads
@@ -0,0 +1,61 @@
+import dataflows as DF
+
+from operators.derive.autocomplete import QUERY_FIELDS, aggregate_queries
+
+ROWS = [
+    dict(query='b', importance=3, response='r3', situation=None, org_name='ארגון', low=True, visible=True),
+    dict(query='a', importance=2, response=None, situation='s2', org_name=None, low=False, visible=None),
+    dict(query='b', importance=1, response=None, situation='s1', org_name=None, low=True, visible=False),
+    dict(query='a', importance=1, response='r1', situation=None, org_name=None, low=None, visible=True),
+    dict(query='b', importance=1, response='r1b', situation='s1b', org_name=None, low=None, visible=None),
+    dict(query='c', importance=5, response=None, situation=None, org_name=None, low=None, visible=None),
+    dict(query='a', importance=2, response='r2', situation='s2b', org_name='שם', low=True, visible=False),
+]
+
+
+def rows():
+    for row in ROWS:
+        ret = dict((field, None) for field in QUERY_FIELDS)
+        ret.update(row, query_heb=row['query'], structured_query=row['query'] + '_structured')
+        yield ret
+
+
+def results(*steps):
+    fields = [dict(name=name, type='string') for name in QUERY_FIELDS]
+    for field in fields:
+        if field['name'] in ('visible', 'low'):
+            field['type'] = 'boolean'
+        elif field['name'] == 'importance':
+            field['type'] = 'integer'
+    descriptor = dict(resources=[dict(name='autocomplete', path='autocomplete.csv', schema=dict(fields=fields))])
+    data, dp, _ = DF.Flow(DF.load((descriptor, [rows()])), *steps).results()
+    return data[0], dp.descriptor['resources'][0]['schema']['fields']
+
+
+def test_same_results_as_join_with_self():
+    # The steps which aggregate_queries replaced
+    expected, expected_fields = results(
+        DF.sort_rows(['importance']),
+        DF.join_with_self('autocomplete', ['query'], fields=dict(
+            score=dict(aggregate='count'),
+            query=None, query_heb=dict(aggregate='first'), importance=dict(aggregate='first'),
+            response=dict(aggregate='first'), situation=dict(aggregate='first'), synonyms=dict(aggregate='first'),
+            org_id=dict(aggregate='first'), org_name=dict(aggregate='first'), city_name=dict(aggregate='first'),
+            response_name=dict(aggregate='first'), situation_name=dict(aggregate='first'),
+            structured_query=dict(aggregate='first'), visible=dict(aggregate='first'), low=dict(aggregate='min'),
+        )),
+    )
+    data, fields = results(aggregate_queries())
+    assert [row['query'] for row in data] == ['a', 'b', 'c']
+    assert [dict(row) for row in data] == [dict(row) for row in expected]
+    assert sorted((f['name'], f['type']) for f in fields) == sorted((f['name'], f['type']) for f in expected_fields)
+
+
+def test_aggregation():
+    data, _ = results(aggregate_queries())
+    a, b, c = data
+    assert (a['importance'], a['response'], a['situation'], a['org_name']) == (1, 'r1', 's2', 'שם')
+    assert (a['score'], a['low'], a['visible']) == (3, False, True)
+    assert (b['importance'], b['response'], b['situation'], b['org_name']) == (1, 'r1b', 's1', 'ארגון')
+    assert (b['score'], b['low'], b['visible']) == (3, True, False)
+    assert (c['score'], c['low'], c['visible']) == (1, None, None)
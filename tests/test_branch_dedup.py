@@ -0,0 +1,107 @@
+import pytest
+import dataflows as DF
+
+from conf import settings
+from operators.derive.to_dp import merge_duplicate_branches
+
+TINY_BUDGET_MB = 1 / (1024 * 1024)
+
+
+def branch(branch_id, name, address, geometry=(34.78, 32.08), phones=None, organization_id='org1'):
+    return dict(
+        organization_id=organization_id, branch_id=branch_id, branch_key='key-' + branch_id,
+        branch_name=name, branch_address=address, branch_geometry=list(geometry) if geometry else None,
+        branch_phone_numbers=phones or [],
+    )
+
+
+FIELDS = [
+    dict(name='organization_id', type='string'),
+    dict(name='branch_id', type='string'),
+    dict(name='branch_key', type='string'),
+    dict(name='branch_name', type='string'),
+    dict(name='branch_address', type='string'),
+    dict(name='branch_geometry', type='geopoint'),
+    dict(name='branch_phone_numbers', type='array'),
+]
+
+
+def dedup(rows):
+    mapping = dict()
+    descriptor = dict(resources=[dict(name='branches', path='branches.csv', schema=dict(fields=FIELDS))])
+    results = DF.Flow(
+        DF.load((descriptor, [iter(rows)])),
+        merge_duplicate_branches(mapping),
+    ).results()[0][0]
+    return results, mapping
+
+
+@pytest.fixture(params=[0, TINY_BUDGET_MB], ids=['in-memory', 'spilled'])
+def budget(request, monkeypatch):
+    monkeypatch.setattr(settings, 'DERIVE_MEMORY_BUDGET_MB', request.param)
+
+
+def test_exact_duplicates_are_merged(budget):
+    rows, mapping = dedup([
+        branch('b1', 'סניף מרכז', 'הרצל 1', phones=['03-1111111']),
+        branch('b2', 'סניף מרכז', 'הרצל 1', phones=['03-2222222']),
+    ])
+    assert len(rows) == 1
+    assert rows[0]['branch_phone_numbers'] == ['03-1111111', '03-2222222']
+    assert rows[0]['organization_branch_count'] == 1
+    assert mapping['key-b1'] == mapping['key-b2'] == rows[0]['branch_key']
+
+
+@pytest.fixture
+def fuzzy(monkeypatch):
+    monkeypatch.setattr(settings, 'DERIVE_FUZZY_BRANCH_MERGE', True)
+
+
+def test_similar_names_are_kept_by_default(budget):
+    rows, mapping = dedup([
+        branch('b1', 'סניף מרכז העיר', 'הרצל 1, תל אביב'),
+        branch('b2', 'סניף מרכז העירי', 'הרצל 1 תל אביב', geometry=(34.7801, 32.0801)),
+    ])
+    assert sorted(row['branch_id'] for row in rows) == ['b1', 'b2']
+    assert mapping['key-b1'] != mapping['key-b2']
+
+
+def test_similar_names_at_the_same_address_are_merged(budget, fuzzy):
+    # The survivor absorbs the later branch after it was already retained - this must hold when it was spilled
+    rows, mapping = dedup([
+        branch('b1', 'סניף מרכז העיר', 'הרצל 1, תל אביב', phones=['03-1111111']),
+        branch('b2', 'סניף מרכז העירי', 'הרצל 1 תל אביב', geometry=(34.7801, 32.0801), phones=['03-2222222']),
+    ])
+    assert len(rows) == 1
+    assert rows[0]['branch_id'] == 'b1'
+    assert rows[0]['branch_phone_numbers'] == ['03-1111111', '03-2222222']
+    assert mapping['key-b2'] == mapping['key-b1'] == rows[0]['branch_key']
+
+
+def test_similar_names_without_an_address_are_kept(budget, fuzzy):
+    rows, mapping = dedup([
+        branch('b1', 'סניף מרכז העיר', None),
+        branch('b2', 'סניף מרכז העירי', '', geometry=(34.7801, 32.0801)),
+    ])
+    assert sorted(row['branch_id'] for row in rows) == ['b1', 'b2']
+    assert all(row['organization_branch_count'] == 2 for row in rows)
+    assert mapping['key-b1'] != mapping['key-b2']
+
+
+def test_branches_of_other_organizations_or_cells_are_kept(budget):
+    rows, _ = dedup([
+        branch('b1', 'סניף מרכז', 'הרצל 1'),
+        branch('b2', 'סניף מרכז', 'הרצל 1', organization_id='org2'),
+        branch('b3', 'סניף מרכז', 'הרצל 1', geometry=(35.0, 31.0)),
+    ])
+    assert sorted(row['branch_id'] for row in rows) == ['b1', 'b2', 'b3']
+
+
+def test_near_miss_names_are_kept(budget):
+    # Distinct branches at one address, whose names only differ by a letter
+    rows, _ = dedup([
+        branch('b1', 'מרכז הטיפול בנוער ובצעירים - סניף א', 'הרצל 1'),
+        branch('b2', 'מרכז הטיפול בנוער ובצעירים - סניף ב', 'הרצל 1', geometry=(34.7801, 32.0801)),
+    ])
+    assert sorted(row['branch_id'] for row in rows) == ['b1', 'b2']
+    assert all(row['organization_branch_count'] == 2 for row in rows)
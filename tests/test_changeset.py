@@ -0,0 +1,35 @@
+import dataflows as DF
+
+from operators.derive import changeset
+
+FIELDS = [dict(name='card_id', type='string'), dict(name='name', type='string')]
+
+
+def dump_snapshot(cards, path='data/card_data'):
+    descriptor = dict(resources=[dict(name='card_data', path='card_data.csv', schema=dict(fields=FIELDS))])
+    DF.Flow(
+        DF.load((descriptor, [iter(cards)])),
+        DF.dump_to_path(path),
+    ).process()
+    return path
+
+
+def test_card_changeset(tmp_path, monkeypatch):
+    # Hashes and changesets are kept under the (relative) data dump directory
+    monkeypatch.chdir(tmp_path)
+    cards = [dict(card_id=str(i), name='card {}'.format(i)) for i in range(5)]
+
+    snapshot = dump_snapshot(cards)
+    assert changeset.card_changeset(snapshot) == dict(added=5, modified=0, removed=0)
+    assert changeset.card_changeset(snapshot) == dict(added=0, modified=0, removed=0)
+
+    cards[1]['name'] = 'renamed'
+    cards = cards[:4] + [dict(card_id='new', name='new card')]
+    snapshot = dump_snapshot(cards)
+    assert changeset.card_changeset(snapshot) == dict(added=1, modified=1, removed=1)
+
+    changes = changeset.load_card_changeset()
+    assert [card_id for card_id, _ in changes['added']] == ['new']
+    assert [card_id for card_id, _ in changes['modified']] == ['1']
+    assert [card_id for card_id, _ in changes['removed']] == ['4']
+    assert set(changeset.load_card_hashes()) == set(card['card_id'] for card in cards)
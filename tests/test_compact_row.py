@@ -0,0 +1,56 @@
+import pickle
+
+from srm_tools.compact_row import CompactRow, FieldIndex, RowPacker
+
+
+def row(**kw):
+    ret = dict(id='1', name='name', tags=['a', 'b'], count=3, geometry=[34.78, 32.08])
+    ret.update(kw)
+    return ret
+
+
+def test_packed_row_reads_like_the_dict():
+    source = row()
+    packed = RowPacker().pack(source)
+    assert isinstance(packed, CompactRow)
+    assert dict(packed) == source
+    assert packed.to_dict() == source
+    assert list(packed) == list(source)
+    assert len(packed) == len(source)
+    assert 'name' in packed and 'other' not in packed
+    assert packed['tags'] == ['a', 'b']
+    assert packed.get('other') is None
+
+
+def test_rows_of_a_schema_share_the_field_index():
+    packer = RowPacker()
+    first, second = packer.pack(row()), packer.pack(row(id='2'))
+    assert first.index is second.index
+    assert FieldIndex.get(row().keys()) is first.index
+    assert packer.pack(dict(id='3')).index is not first.index
+
+
+def test_strings_are_interned_per_field():
+    packer = RowPacker()
+    # Build equal strings that aren't the same object
+    first = packer.pack(row(name=''.join(['na', 'me']), tags=[''.join(['a', 'b'])]))
+    second = packer.pack(row(name=''.join(['na', 'me']), tags=[''.join(['a', 'b'])]))
+    assert first['name'] is second['name']
+    assert first['tags'][0] is second['tags'][0]
+
+
+def test_interning_stops_at_the_limit():
+    packer = RowPacker(max_interned=2)
+    for i in range(3):
+        packer.pack(row(id=str(i)))
+    assert packer.interned['id'] is None
+    assert packer.interned['name'] is not None
+    assert packer.pack(row(id='new'))['id'] == 'new'
+
+
+def test_pickle_round_trip():
+    packed = RowPacker().pack(row())
+    restored = pickle.loads(pickle.dumps(packed))
+    assert isinstance(restored, CompactRow)
+    assert restored.index is packed.index
+    assert restored.to_dict() == row()
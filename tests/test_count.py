@@ -0,0 +1,47 @@
+import pytest
+import dataflows as DF
+
+from srm_tools.count import KeyCounter
+
+TINY_BUDGET_MB = 1 / (1024 * 1024)
+
+ROWS = [
+    dict(org='o1', tags=['a', 'b'], kind='x'),
+    dict(org='o1', tags=['a'], kind='y'),
+    dict(org='o2', tags=[], kind='x'),
+    dict(org=None, tags=['b'], kind=None),
+]
+
+
+@pytest.mark.parametrize('budget_mb', [None, TINY_BUDGET_MB])
+def test_counts(budget_mb):
+    counter = KeyCounter(
+        dict(orgs=lambda row: row['org'], tags=lambda row: row['tags']),
+        category=lambda row: row['kind'], budget_mb=budget_mb,
+    ).count([dict(row) for row in ROWS])
+    assert sorted(counter.counts('orgs'), key=lambda row: row['id']) == [
+        dict(id='o1', count=2, category_counts=dict(x=1, y=1)),
+        dict(id='o2', count=1, category_counts=dict(x=1)),
+    ]
+    assert sorted(counter.counts('tags'), key=lambda row: row['id']) == [
+        dict(id='a', count=2, category_counts=dict(x=1, y=1)),
+        # Rows without a category are counted, but not broken down
+        dict(id='b', count=2, category_counts=dict(x=1)),
+    ]
+
+
+def test_counting_passes_rows_through():
+    counter = KeyCounter(dict(orgs=lambda row: row['org']))
+    rows = DF.Flow([dict(row) for row in ROWS], counter.counting()).results()[0][0]
+    assert len(rows) == len(ROWS)
+    assert sorted(counter.counts('orgs'), key=lambda row: row['id']) == [
+        dict(id='o1', count=2, category_counts=dict()),
+        dict(id='o2', count=1, category_counts=dict()),
+    ]
+
+
+def test_resource():
+    counter = KeyCounter(dict(orgs=lambda row: row['org'])).count([dict(row) for row in ROWS])
+    data, dp, _ = DF.Flow(counter.resource('orgs', 'org_counts')).results()
+    assert dp.descriptor['resources'][0]['name'] == 'org_counts'
+    assert sorted(row['count'] for row in data[0]) == [1, 2]
@@ -0,0 +1,211 @@
+import copy
+
+import pytest
+import dataflows as DF
+
+from conf import settings
+from operators.derive import dependencies
+from operators.derive.dependencies import CARD_TAXONOMY_FIELDS, GLOBAL_RESOURCE
+
+RULES = [dict(fields=['service_name'], query='נוער', situation_ids=['human_situations:age_group:youth'], response_ids=[])]
+
+TAXONOMY_FIELDS = [dict(name='key', type='string'), dict(name='id', type='string'), dict(name='name', type='string')]
+SRM_DATA_FIELDS = dict(
+    responses=TAXONOMY_FIELDS,
+    situations=TAXONOMY_FIELDS,
+    organizations=[dict(name='key', type='string'), dict(name='name', type='string')],
+    locations=[dict(name='key', type='string'), dict(name='address', type='string')],
+    branches=[
+        dict(name='key', type='string'), dict(name='name', type='string'),
+        dict(name='organization', type='array'), dict(name='location', type='array'),
+    ],
+    services=[
+        dict(name='key', type='string'), dict(name='name', type='string'), dict(name='situations', type='array'),
+        dict(name='organizations', type='array'), dict(name='branches', type='array'),
+    ],
+)
+CARD_FIELDS = [
+    dict(name='card_id', type='string'), dict(name='organization_key', type='string'),
+    dict(name='service_name', type='string'), dict(name='branch_name', type='string'), dict(name='address', type='string'),
+] + [dict(name=name, type='array') for name in CARD_TAXONOMY_FIELDS]
+
+
+def srm_data(organizations=4):
+    return dict(
+        responses=[dict(key='r1', id='human_services:health', name='בריאות')],
+        situations=[
+            dict(key='s1', id='human_situations:age_group:youth', name='נוער'),
+            dict(key='s2', id='human_situations:disability', name='מוגבלות'),
+        ],
+        organizations=[dict(key=f'o{i}', name=f'ארגון {i}') for i in range(organizations)],
+        locations=[dict(key=f'l{i}', address=f'הרצל {i}') for i in range(organizations)],
+        branches=[
+            dict(key=f'b{i}', name=f'סניף {i}', organization=[f'o{i}'], location=[f'l{i}'])
+            for i in range(organizations)
+        ],
+        services=[
+            dict(key=f'sv{i}', name=f'שירות {i}', situations=['s1' if i == 0 else 's2'],
+                 organizations=[], branches=[f'b{i}'])
+            for i in range(organizations)
+        ],
+    )
+
+
+def dump_srm_data(data):
+    descriptor = dict(name='srm_data', resources=[
+        dict(name=name, path=f'{name}.csv', schema=dict(fields=fields)) for name, fields in SRM_DATA_FIELDS.items()
+    ])
+    DF.Flow(
+        DF.load((descriptor, [iter(copy.deepcopy(data[name])) for name in SRM_DATA_FIELDS])),
+        DF.dump_to_path(f'{settings.DATA_DUMP_DIR}/srm_data'),
+    ).process()
+
+
+def cards(data):
+    """A stand-in for the card flow - a card per service and branch, with the organization of the branch."""
+    situations = dict((s['key'], s['id']) for s in data['situations'])
+    branches = dict((b['key'], b) for b in data['branches'])
+    locations = dict((loc['key'], loc) for loc in data['locations'])
+    ret = []
+    for service in data['services']:
+        for branch in map(branches.get, service['branches']):
+            card = dict(
+                card_id='{}:{}'.format(service['key'], branch['key']), organization_key=branch['organization'][0],
+                service_name=service['name'], branch_name=branch['name'],
+                address=locations[branch['location'][0]]['address'],
+            )
+            card.update((name, None) for name in CARD_TAXONOMY_FIELDS)
+            card['service_situations'] = service['situations']
+            card['situation_ids'] = [situations[s] for s in service['situations']]
+            ret.append(card)
+    return ret
+
+
+def derive(data, plan):
+    """Derive cards as the card flow does - restricted to the plan, spliced and stored before scoring."""
+    descriptor = dict(resources=[dict(name='card_data', path='card_data.csv', schema=dict(fields=CARD_FIELDS))])
+    rows = DF.Flow(
+        DF.load((descriptor, [iter(cards(data))])),
+        plan.restrict('organization_key', resources=['card_data']),
+        plan.splice_retained_cards(resources=['card_data']),
+        plan.store_cards(),
+    ).results()[0][0]
+    plan.commit()
+    return sorted(rows, key=lambda row: row['card_id'])
+
+
+@pytest.fixture
+def incremental(tmp_path, monkeypatch):
+    # The snapshots are kept under the (relative) data dump directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'INCREMENTAL_DERIVE', True)
+    monkeypatch.setattr(settings, 'INCREMENTAL_DERIVE_MAX_FRACTION', 0.5)
+
+
+def run(data, rules=RULES):
+    dump_srm_data(data)
+    plan = dependencies.plan_derivation(rules)
+    return plan, derive(data, plan)
+
+
+def test_first_run_is_full(incremental):
+    plan, rows = run(srm_data())
+    assert plan.full and plan.reason == 'no previous run'
+    assert len(rows) == 4
+
+
+def test_unchanged_sources_derive_nothing(incremental):
+    data = srm_data()
+    run(data)
+    plan, rows = run(data)
+    assert plan.organizations == set()
+    assert rows == sorted(cards(data), key=lambda row: row['card_id'])
+
+
+@pytest.mark.parametrize('change, organizations', [
+    (lambda data: data['services'][1].update(name='שירות חדש'), {'o1'}),
+    (lambda data: data['organizations'][2].update(name='ארגון חדש'), {'o2'}),
+    # Location -> branch -> organization
+    (lambda data: data['locations'][3].update(address='הרצל 100'), {'o3'}),
+    # Moving a branch to another organization affects both organizations
+    (lambda data: data['branches'][1].update(organization=['o2']), {'o1', 'o2'}),
+    # Taxonomy entries are traced through the taxonomy fields of the previous run's cards
+    (lambda data: data['situations'][0].update(name='בני נוער'), {'o0'}),
+])
+def test_incremental_derive(incremental, change, organizations):
+    data = srm_data()
+    run(data)
+    change(data)
+    plan, rows = run(data)
+    assert not plan.full
+    assert plan.organizations == organizations
+    # Spliced and derived cards are the same as a full rebuild
+    assert rows == sorted(cards(data), key=lambda row: row['card_id'])
+
+
+@pytest.mark.parametrize('rules, change, reason', [
+    ([], None, 'auto tagging rules, code or settings changed'),
+    (RULES, lambda monkeypatch: monkeypatch.setattr(dependencies, 'code_fingerprint', lambda: 'changed'),
+     'auto tagging rules, code or settings changed'),
+    (RULES, lambda monkeypatch: monkeypatch.setattr(settings, 'DERIVE_FUZZY_BRANCH_MERGE', True),
+     'auto tagging rules, code or settings changed'),
+    (RULES, lambda monkeypatch: monkeypatch.setattr(settings, 'INCREMENTAL_DERIVE', False),
+     'incremental derivation is disabled'),
+])
+def test_global_changes_rebuild(incremental, monkeypatch, rules, change, reason):
+    data = srm_data()
+    run(data)
+    if change:
+        change(monkeypatch)
+    data['services'][1].update(name='שירות חדש')
+    plan, rows = run(data, rules)
+    assert plan.full and plan.reason == reason
+    assert rows == sorted(cards(data), key=lambda row: row['card_id'])
+
+
+def test_too_many_changes_rebuild(incremental):
+    data = srm_data()
+    run(data)
+    for service in data['services'][:3]:
+        service['name'] += ' חדש'
+    plan, rows = run(data)
+    assert plan.full and plan.reason == '3 of 4 organizations changed'
+    assert rows == sorted(cards(data), key=lambda row: row['card_id'])
+
+
+def record(resource, key, hash_, **refs):
+    refs.setdefault('organizations', [])
+    refs.setdefault('branches', [])
+    refs.setdefault('locations', [])
+    refs.setdefault('taxonomy', [])
+    return (resource, key), dict(resource=resource, key=key, hash=hash_, **refs)
+
+
+def test_affected_organizations_of_a_moved_service():
+    previous = dict([
+        record('services', 'sv1', 'a', organizations=['o1'], branches=['b1']),
+        record('branches', 'b1', 'a', organizations=['o2']),
+        record('branches', 'b3', 'a', organizations=['o3']),
+    ])
+    current = dict(previous)
+    current.update([record('services', 'sv1', 'b', organizations=['o4'], branches=['b3'])])
+    changed = dependencies.changed_records(previous, current)
+    assert changed == [('services', 'sv1')]
+    assert dependencies.affected_organizations(changed, previous, current) == {'o1', 'o2', 'o3', 'o4'}
+
+
+def test_removed_and_added_records():
+    previous = dict([record('organizations', 'o1', 'a'), record(GLOBAL_RESOURCE, 'code', 'a')])
+    current = dict([record('organizations', 'o2', 'a'), record(GLOBAL_RESOURCE, 'code', 'a')])
+    changed = dependencies.changed_records(previous, current)
+    assert sorted(changed) == [('organizations', 'o1'), ('organizations', 'o2')]
+    assert dependencies.affected_organizations(changed, previous, current) == {'o1', 'o2'}
+
+
+def test_derivation_modules():
+    modules = dependencies.derivation_modules()
+    for name in ['operators.derive.to_dp', 'operators.derive.manual_fixes', 'srm_tools.hash', 'srm_tools.unwind',
+                 'srm_tools.spill', 'srm_tools.compact_row', 'srm_tools.fast_load', 'srm_tools.data_cleaning']:
+        assert name in modules
+    # Flows which only read the derived cards don't force rebuilding them
+    assert 'operators.derive.to_es' not in modules
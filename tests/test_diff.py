@@ -0,0 +1,89 @@
+import decimal
+
+import pytest
+
+from srm_tools import diff
+from srm_tools.diff import DIFFERENT, DUPLICATE, ONLY_LEFT, ONLY_RIGHT
+
+TINY_BUDGET_MB = 1 / (1024 * 1024)
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    ('', None),
+    ('  ', None),
+    (' a ', 'a'),
+    (float('nan'), None),
+    (decimal.Decimal('2.0'), 2),
+    (2.0, 2),
+    (2.5, 2.5),
+    (True, True),
+    ([], None),
+    (dict(a=None, b=''), None),
+    (dict(a=' x ', b=None), dict(a='x')),
+    ([' b', 'a'], ['b', 'a']),
+    ({'b', 'a'}, ['a', 'b']),
+])
+def test_normalize(value, expected):
+    assert diff.normalize(value) == expected
+
+
+def test_normalize_unordered():
+    assert diff.normalize(['b', 'a'], unordered=True) == diff.normalize(['a', 'b'], unordered=True)
+    assert diff.normalize(['b', 'a']) != diff.normalize(['a', 'b'])
+
+
+def rows():
+    left = [
+        dict(id='1', name='same', tags=['a', 'b']),
+        dict(id='2', name='left', tags=[]),
+        dict(id='3', name='only left', tags=None),
+        dict(id='4', name='dup', tags=None),
+        dict(id='4', name='dup again', tags=None),
+        dict(id=None, name='no key', tags=None),
+    ]
+    right = [
+        dict(key='4', name='dup', tags=None),
+        dict(key='5', name='only right', tags=None),
+        dict(key='2', name='right', tags=None),
+        dict(key='1', name='same ', tags=['b', 'a']),
+    ]
+    return left, right
+
+
+def run(**kw):
+    left, right = rows()
+    return sorted(
+        diff.diff(iter(left), iter(right), 'id', right_key='key', **kw),
+        key=lambda d: (d['key'], d['kind'], d.get('field') or '')
+    )
+
+
+def test_diff():
+    assert run(unordered=['tags']) == [
+        dict(key='2', kind=DIFFERENT, field='name', left='left', right='right'),
+        dict(key='3', kind=ONLY_LEFT, row=dict(name='only left', tags=None)),
+        dict(key='4', kind=DUPLICATE, side='left', count=2),
+        dict(key='5', kind=ONLY_RIGHT, row=dict(name='only right', tags=None)),
+    ]
+
+
+def test_diff_ordered_lists_and_fields():
+    discrepancies = run(fields=['tags'])
+    assert [(d['key'], d['kind']) for d in discrepancies] == [
+        ('1', DIFFERENT), ('3', ONLY_LEFT), ('4', DUPLICATE), ('5', ONLY_RIGHT)
+    ]
+    assert discrepancies[0]['field'] == 'tags'
+
+
+def test_diff_spilled():
+    assert run(unordered=['tags'], budget_mb=TINY_BUDGET_MB) == run(unordered=['tags'])
+
+
+def test_report():
+    summary = diff.report(run(), examples=1)
+    assert summary[ONLY_LEFT] == dict(count=1, examples=['3'])
+    assert summary[ONLY_RIGHT] == dict(count=1, examples=['5'])
+    assert summary[DUPLICATE] == dict(count=1, examples=['4'])
+    assert summary['fields'] == dict(name=dict(count=1, examples=['2']), tags=dict(count=1, examples=['1']))
+    assert 'only in db: 1' in diff.format_report(summary, left_name='db')
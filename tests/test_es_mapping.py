@@ -0,0 +1,107 @@
+import pytest
+import dataflows as DF
+
+from operators.derive import es_utils, to_es
+from operators.derive.es_schemas import (RANK_FEATURE, SEARCH_PROFILE, FILTER_PROFILE, AGGREGATE_PROFILE, DISPLAY_PROFILE,
+                                         KEYWORD_STRING)
+
+ALIAS = 'srm__cards'
+
+
+def dump_cards(cards, *steps, **kwargs):
+    DF.Flow(
+        cards,
+        DF.update_resource(-1, name='cards'),
+        DF.set_primary_key(['card_id']),
+        *steps,
+        es_utils.dump_to_es_and_delete(indexes={ALIAS: [dict(resource_name='cards')]}, **kwargs),
+    ).process()
+
+
+def current_index(es):
+    index, = [index for index in es.store.indexes.values() if ALIAS in index.aliases]
+    return index
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, None),
+    (0, None),
+    (-1.5, None),
+    (1e-40, None),
+    (0.5, 0.5),
+    (12, 12.0),
+])
+def test_rank_feature(value, expected):
+    assert to_es.rank_feature(value) == expected
+
+
+def test_rank_feature_mapping(es):
+    scores = [None, 0, -2.5, 1e-40, 0.25, 3]
+    dump_cards(
+        [dict(card_id=str(i), score=score) for i, score in enumerate(scores)],
+        DF.set_type('score', type='number'),
+        DF.add_field('score_rank', 'number', lambda r: to_es.rank_feature(r['score']), **RANK_FEATURE),
+        alias_settings={ALIAS: to_es.CARDS_INDEX_SETTINGS},
+    )
+    index = current_index(es)
+    assert index.mappings['properties']['score_rank'] == dict(type='rank_feature', positive_score_impact=True)
+    assert index.mappings['properties']['score']['type'] != 'rank_feature'
+    ranks = dict((doc['card_id'], doc.get('score_rank')) for doc in index.docs.values())
+    assert ranks == {'0': None, '1': None, '2': None, '3': None, '4': 0.25, '5': 3.0}
+    # The cards index is sorted by score
+    assert index.settings['sort'] == dict(field='score', order='desc')
+
+
+@pytest.mark.parametrize('prop, profile, expected', [
+    (dict(type='keyword'), 'display', dict(type='keyword', index=False, doc_values=False)),
+    (dict(type='text', fields=dict(hebrew=dict(type='text'))), 'display', dict(type='text', index=False)),
+    (dict(type='long'), 'search', dict(type='long', index=True, doc_values=False)),
+    (dict(type='text'), 'search', dict(type='text', index=True)),
+    (dict(type='keyword'), 'filter', dict(type='keyword', index=True, doc_values=False)),
+    (dict(type='text'), 'filter', dict(type='text', index=True, norms=False, index_options='docs')),
+    (dict(type='keyword'), 'aggregate', dict(type='keyword', index=True, doc_values=True, eager_global_ordinals=True)),
+    (dict(type='long'), 'aggregate', dict(type='long', index=True, doc_values=True)),
+    (dict(properties=dict(a=dict(type='keyword'))), 'display', dict(properties={}, enabled=False)),
+])
+def test_apply_profile(prop, profile, expected):
+    assert es_utils.apply_profile(prop, profile, 'field') == expected
+
+
+@pytest.mark.parametrize('prop, profile', [
+    (dict(type='keyword'), 'sort'),
+    (dict(type='text'), 'aggregate'),
+])
+def test_apply_profile_errors(prop, profile):
+    with pytest.raises(ValueError):
+        es_utils.apply_profile(prop, profile, 'field')
+
+
+def test_profile_mapping(es):
+    dump_cards(
+        [dict(
+            card_id='1', service_name='שירות', service_description='תיאור', branch_urls='https://example.com',
+            organization_id='org1', response_ids=['human_services:health'], geohash_5='sv8wr', service_id='s1',
+            branch_id='b1', count=3,
+        )],
+        DF.set_type('service_description', **SEARCH_PROFILE),
+        DF.set_type('branch_urls', **DISPLAY_PROFILE),
+        DF.set_type('count', type='integer', **FILTER_PROFILE),
+        DF.set_type('response_ids', type='array', **KEYWORD_STRING),
+        DF.set_type('geohash_5', **KEYWORD_STRING),
+        DF.set_type('(organization_id|service_id|branch_id)', **KEYWORD_STRING),
+        *[DF.set_type(name, **profile) for name, profile in to_es.CARD_FIELD_PROFILES],
+    )
+    properties = current_index(es).mappings['properties']
+    assert properties['branch_urls']['index'] is False
+    assert 'fields' not in properties['branch_urls']
+    assert properties['service_description']['index'] is True
+    assert properties['count']['index'] is True and properties['count']['doc_values'] is False
+    for name in ('organization_id', 'response_ids', 'geohash_5'):
+        assert properties[name] == dict(type='keyword', index=True, doc_values=True, eager_global_ordinals=True)
+    # Without a profile
+    for name in ('service_id', 'branch_id'):
+        assert properties[name] == dict(type='keyword')
+    assert 'index' not in properties['service_name']
+    # The documents are stored in full
+    doc, = current_index(es).docs.values()
+    assert doc['branch_urls'] == 'https://example.com'
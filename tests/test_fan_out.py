@@ -0,0 +1,58 @@
+import pytest
+import dataflows as DF
+
+from dataflows.base.exceptions import ProcessorError
+
+from srm_tools.fan_out import fan_out
+
+
+def source(count=50, fail_at=None):
+    def rows():
+        for i in range(count):
+            if i == fail_at:
+                raise ValueError('source failed')
+            yield dict(id=i)
+    return DF.Flow(rows(), DF.update_resource(-1, name='items'))
+
+
+def sink(results, *steps):
+    def func(load):
+        results.extend(DF.Flow(load, *steps).results()[0][0])
+    return func
+
+
+def test_every_sink_gets_every_row():
+    first, second = [], []
+    fan_out(source(), sink(first), sink(second, DF.add_field('double', 'integer', lambda row: row['id'] * 2)))
+    assert first == [dict(id=i) for i in range(50)]
+    assert second == [dict(id=i, double=i * 2) for i in range(50)]
+
+
+def test_rows_are_copied_per_sink():
+    first, second = [], []
+
+    def mutate(row):
+        row['id'] = -1
+
+    fan_out(source(), sink(first, mutate), sink(second))
+    assert all(row['id'] == -1 for row in first)
+    assert second == [dict(id=i) for i in range(50)]
+
+
+def test_source_failure_fails_the_sinks():
+    results = []
+    # A small queue keeps the sinks waiting for rows when the source fails
+    with pytest.raises(ProcessorError) as e:
+        fan_out(source(fail_at=10), sink(results), sink([]), queue_size=2)
+    assert isinstance(e.value.cause, ValueError)
+    assert len(results) == 0
+
+
+def test_sink_failure_is_raised():
+    def failing(load):
+        raise KeyError('sink failed')
+
+    results = []
+    with pytest.raises(KeyError):
+        fan_out(source(count=5000), failing, sink(results), queue_size=2)
+    assert len(results) == 5000
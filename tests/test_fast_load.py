@@ -0,0 +1,84 @@
+import datetime
+import decimal
+
+import pytest
+import dataflows as DF
+
+from srm_tools.fast_load import load_trusted
+
+FIELDS = [
+    dict(name='id', type='string'),
+    dict(name='count', type='integer'),
+    dict(name='score', type='number'),
+    dict(name='active', type='boolean'),
+    dict(name='tags', type='array'),
+    dict(name='extra', type='object'),
+    dict(name='created', type='date'),
+    dict(name='updated', type='datetime'),
+    dict(name='location', type='geopoint'),
+]
+
+ROWS = [
+    dict(
+        id='1', count=3, score=decimal.Decimal('1.5'), active=True, tags=['a', 'ב'], extra=dict(x=1),
+        created=datetime.date(2024, 1, 2), updated=datetime.datetime(2024, 1, 2, 3, 4, 5), location=[34.78, 32.08],
+    ),
+    dict(
+        id='2', count=None, score=None, active=False, tags=[], extra=None,
+        created=None, updated=None, location=None,
+    ),
+    dict(
+        id=' padded, "quoted"\nline ', count=0, score=decimal.Decimal('-2'), active=None, tags=None, extra=dict(),
+        created=datetime.date(1999, 12, 31), updated=None, location=[35, 31.5],
+    ),
+]
+
+
+@pytest.fixture
+def package(tmp_path):
+    descriptor = dict(resources=[
+        dict(name='first', path='first.csv', schema=dict(fields=FIELDS, primaryKey=['id'])),
+        dict(name='second', path='second.csv', schema=dict(fields=FIELDS[:3])),
+    ])
+    DF.Flow(
+        DF.load((descriptor, [
+            # Loading casts the rows in place
+            (dict(row) for row in ROWS),
+            (dict((f['name'], row[f['name']]) for f in FIELDS[:3]) for row in ROWS),
+        ])),
+        DF.dump_to_path(str(tmp_path)),
+    ).process()
+    return str(tmp_path / 'datapackage.json')
+
+
+def results(*steps):
+    data, dp, _ = DF.Flow(*steps).results()
+    return data, dp.descriptor['resources']
+
+
+def test_same_results_as_load(package):
+    expected, expected_resources = results(DF.load(package))
+    data, resources = results(load_trusted(package))
+    assert data == expected
+    # Geopoints are loaded as decimals
+    assert dict(data[0][0], location=None) == dict(ROWS[0], location=None)
+    assert [float(x) for x in data[0][0]['location']] == ROWS[0]['location']
+    assert len(data[0]) == len(ROWS)
+    assert [res['schema'] for res in resources] == [res['schema'] for res in expected_resources]
+
+
+def test_resources_and_limit(package):
+    expected, _ = results(DF.load(package, resources=['second'], limit_rows=2))
+    data, resources = results(load_trusted(package, resources=['second'], limit_rows=2))
+    assert [res['name'] for res in resources] == ['second']
+    assert data == expected
+
+
+def test_selected_fields(package):
+    expected, _ = results(DF.load(package), DF.select_fields(['count', 'tags'], resources=['first']))
+    data, resources = results(load_trusted(package, fields=dict(first=['count', 'tags'])))
+    assert data == expected
+    assert [f['name'] for f in resources[0]['schema']['fields']] == ['count', 'tags']
+    # The primary key isn't among the selected fields
+    assert 'primaryKey' not in resources[0]['schema']
+    assert [f['name'] for f in resources[1]['schema']['fields']] == ['id', 'count', 'score']
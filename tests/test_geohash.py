@@ -0,0 +1,31 @@
+import pytest
+import dataflows as DF
+
+from srm_tools import geohash
+
+
+@pytest.mark.parametrize('lat, lon, precision, expected', [
+    (57.64911, 10.40744, 11, 'u4pruydqqvj'),
+    (42.6, -5.6, 5, 'ezs42'),
+    (-25.382708, -49.265506, 9, '6gkzwgjzn'),
+])
+def test_encode(lat, lon, precision, expected):
+    assert geohash.encode(lat, lon, precision) == expected
+
+
+def test_prefixes_are_containing_cells():
+    full = geohash.encode(32.0853, 34.7818, 9)
+    for precision in range(1, 9):
+        assert geohash.encode(32.0853, 34.7818, precision) == full[:precision]
+
+
+def test_add_geohash_fields():
+    rows = DF.Flow(
+        [dict(geometry=[34.7818, 32.0853]), dict(geometry=None)],
+        DF.update_resource(-1, name='points'),
+        geohash.add_geohash_fields('geometry'),
+    ).results()[0][0]
+    assert [rows[0][geohash.field_name(p)] for p in geohash.PRECISIONS] == [
+        geohash.encode(32.0853, 34.7818, p) for p in geohash.PRECISIONS
+    ]
+    assert all(rows[1][geohash.field_name(p)] is None for p in geohash.PRECISIONS)
@@ -0,0 +1,40 @@
+import pytest
+
+from srm_tools import hebrew
+
+
+@pytest.mark.parametrize('text, expected', [
+    (None, ''),
+    ('', ''),
+    ('שָׁלוֹם', 'שלומ'),
+    ('צה"ל', 'צהל'),
+    ('צה״ל', 'צהל'),
+    ("ג'ירפה", 'גירפה'),
+    ('"ציטוט"', '"ציטוט"'),
+    ('בית־ספר', 'בית ספר'),
+    ('ארץ', 'ארצ'),
+    ('Hello עולם', 'hello עולמ'),
+])
+def test_normalize(text, expected):
+    assert hebrew.normalize(text) == expected
+
+
+def test_tokens():
+    assert hebrew.tokens('מרכז סיוע, לנוער בסיכון - צה"ל!') == ['מרכז', 'סיוע', 'לנוער', 'בסיכונ', 'צהל']
+
+
+@pytest.mark.parametrize('token, expected', [
+    ('לנוער', ['נוער']),
+    ('ולנוער', ['לנוער', 'נוער']),
+    ('ומהבית', ['מהבית', 'הבית']),
+    ('נוער', []),
+    ('לבד', []),
+    ('שלום', ['לום']),
+])
+def test_stems(token, expected):
+    assert hebrew.stems(token) == expected
+
+
+def test_search_text():
+    text = hebrew.search_text([('לנוער', 2), (None, 3), ('סיוע', 1)])
+    assert text.split() == ['לנוער', 'לנוער', 'נוער', 'סיוע']
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from srm_tools import spill
+from srm_tools.spill import SpillingBuffer, SpillingCounter, SpillingGrouper
+
+# A budget of a single byte, so every item is spilled
+TINY_BUDGET_MB = 1 / (1024 * 1024)
+
+
+def keys(count=500, distinct=37, seed=0):
+    rng = random.Random(seed)
+    return ['key-{:03d}'.format(rng.randrange(distinct)) for _ in range(count)]
+
+
+def test_memory_budget():
+    assert spill.memory_budget(0) is None
+    assert spill.memory_budget(1) == 1024 * 1024
+
+
+@pytest.mark.parametrize('budget_mb', [None, 0, TINY_BUDGET_MB])
+def test_counter(budget_mb):
+    counter = SpillingCounter(budget_mb)
+    expected = dict()
+    for key in keys():
+        counter.add(key)
+        expected[key] = expected.get(key, 0) + 1
+    counter.add('key-000', 10)
+    expected['key-000'] = expected.get('key-000', 0) + 10
+    assert dict(counter.items()) == expected
+
+
+def test_counter_spills_sorted_runs():
+    counter = SpillingCounter(TINY_BUDGET_MB)
+    for key in keys():
+        counter.add(key)
+    assert counter.runs
+    items = list(counter.items())
+    assert [key for key, _ in items] == sorted(key for key, _ in items)
+    # Runs are removed once read
+    assert counter.tmpdir is None
+
+
+def test_counter_in_memory_keeps_insertion_order():
+    counter = SpillingCounter()
+    for key in ['b', 'a', 'b', 'c']:
+        counter.add(key)
+    assert list(counter.items()) == [('b', 2), ('a', 1), ('c', 1)]
+
+
+@pytest.mark.parametrize('budget_mb', [None, 0, TINY_BUDGET_MB])
+def test_grouper(budget_mb):
+    grouper = SpillingGrouper(budget_mb)
+    expected = dict()
+    for i, key in enumerate(keys()):
+        grouper.add(key, dict(i=i))
+        expected.setdefault(key, []).append(dict(i=i))
+    # Values keep their order within a group, also across runs
+    assert dict(grouper.items()) == expected
+
+
+def test_grouper_spills_many_runs():
+    grouper = SpillingGrouper(TINY_BUDGET_MB)
+    count = spill.MAX_OPEN_RUNS * 3
+    for i in range(count):
+        grouper.add(i % 5, i)
+    # Runs are compacted once there are too many of them
+    assert len(grouper.runs) < spill.MAX_OPEN_RUNS
+    assert dict(grouper.items()) == dict((k, list(range(k, count, 5))) for k in range(5))
+
+
+@pytest.mark.parametrize('budget_mb', [None, TINY_BUDGET_MB])
+def test_buffer(budget_mb):
+    buffer = SpillingBuffer(budget_mb)
+    items = [dict(i=i, key=key) for i, key in enumerate(keys(count=spill.MAX_OPEN_RUNS * 2))]
+    for item in items:
+        buffer.append(item)
+    assert len(buffer) == len(items)
+    assert list(buffer) == items
@@ -0,0 +1,94 @@
+import dataflows as DF
+
+from conf import settings
+from operators.derive import to_es
+
+FIELDS = [
+    dict(name='card_id', type='string'),
+    dict(name='service_id', type='string'),
+    dict(name='national_service', type='boolean'),
+    dict(name='score', type='number'),
+    dict(name='branch_geometry', type='geopoint'),
+] + [dict(name=name, type='string') for name in to_es.CARD_DETAIL_FIELDS]
+
+
+def card(card_id, service_id, national, score, geometry):
+    return dict(
+        card_id=card_id, service_id=service_id, national_service=national, score=score, branch_geometry=geometry,
+        service_key='key-' + card_id,
+    )
+
+
+CARDS = [
+    card('c1', 's1', True, 1, [34.78, 32.08]),
+    card('c2', 's1', True, 3, [35.21, 31.77]),
+    card('c3', 's1', True, 2, [34.78, 32.08]),
+    card('c4', 's2', False, 5, [34.99, 32.79]),
+    card('c5', 's3', True, 1, None),
+]
+
+
+def lean_canonical_cards():
+    descriptor = dict(resources=[dict(name='cards', path='cards.csv', schema=dict(fields=FIELDS))])
+    data, dp, _ = DF.Flow(
+        DF.load((descriptor, [iter(dict(row) for row in CARDS)])),
+        to_es.split_card_details(),
+        to_es.canonical_national_services(),
+    ).results()
+    names = [res['name'] for res in dp.descriptor['resources']]
+    return dict(zip(names, data))
+
+
+def test_canonical_national_services():
+    cards = dict((row['card_id'], row) for row in lean_canonical_cards()['cards'])
+    assert sorted(cards) == ['c2', 'c4', 'c5']
+    assert cards['c2']['national_card_ids'] == ['c1', 'c2', 'c3']
+    assert len(cards['c2']['branch_geometries']) == 2
+    assert cards['c4']['national_card_ids'] is None
+    assert cards['c5']['national_card_ids'] == ['c5']
+    assert cards['c5']['branch_geometries'] is None
+    # Detail fields are only kept in card_details
+    assert not set(to_es.CARD_DETAIL_FIELDS) & set(cards['c2'])
+
+
+def test_lean_cards_keep_the_details_of_every_national_card():
+    resources = lean_canonical_cards()
+    details = dict((row['card_id'], row['card']) for row in resources['card_details'])
+    assert sorted(details) == sorted(card['card_id'] for card in CARDS)
+    for row in resources['cards']:
+        for card_id in row['national_card_ids'] or [row['card_id']]:
+            assert details[card_id]['service_key'] == 'key-' + card_id
+
+
+def test_count_cards(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'DATA_DUMP_DIR', str(tmp_path))
+    fields = [
+        dict(name='card_id', type='string'), dict(name='organization_id', type='string'),
+        dict(name='response_category', type='string'),
+        dict(name='responses', type='array'), dict(name='situations', type='array'),
+    ]
+    descriptor = dict(resources=[dict(name='card_data', path='card_data.csv', schema=dict(fields=fields))])
+    cards = [
+        dict(card_id='1', organization_id='o1', response_category='health',
+             responses=[dict(id='human_services:health:clinic')], situations=[dict(id='human_situations:age_group:youth')]),
+        dict(card_id='2', organization_id='o1', response_category='care',
+             responses=[dict(id='human_services:care')], situations=None),
+        dict(card_id='3', organization_id='o2', response_category=None,
+             responses=[dict(id='human_services:health')], situations=[]),
+    ]
+    DF.Flow(
+        DF.load((descriptor, [iter(cards)])),
+        DF.dump_to_path(f'{tmp_path}/card_data'),
+    ).process()
+
+    counter = to_es.count_cards()
+    organizations = dict((row['id'], row) for row in counter.counts('organizations'))
+    assert organizations['o1'] == dict(id='o1', count=2, category_counts=dict(health=1, care=1))
+    assert organizations['o2'] == dict(id='o2', count=1, category_counts=dict())
+    # Cards are counted for the parents of their responses and situations too
+    responses = dict((row['id'], row['count']) for row in counter.counts('responses'))
+    assert responses == {
+        'human_services:health': 2, 'human_services:health:clinic': 1, 'human_services:care': 1,
+    }
+    situations = dict((row['id'], row['count']) for row in counter.counts('situations'))
+    assert situations == {'human_situations:age_group': 1, 'human_situations:age_group:youth': 1}
@@ -0,0 +1,59 @@
+import pickle
+
+import pytest
+import dataflows as DF
+
+from srm_tools.unwind import OverlayRow, unwind
+
+
+def base():
+    return dict(id='1', values=['a', 'b'], name='name')
+
+
+def test_overlay_reads_like_a_copy():
+    row = OverlayRow(base(), 'value', 'a', hidden='values')
+    expected = dict(id='1', name='name', value='a')
+    assert dict(row) == expected
+    assert list(row) == list(expected)
+    assert len(row) == 3
+    assert row['value'] == 'a' and row['id'] == '1'
+    assert 'values' not in row and 'value' in row
+    with pytest.raises(KeyError):
+        row['values']
+    assert row.get('values') is None
+    assert row.copy() == expected
+
+
+def test_overlay_overrides_an_existing_field():
+    row = OverlayRow(base(), 'name', 'other')
+    assert list(row) == ['id', 'values', 'name']
+    assert row['name'] == 'other'
+    assert len(row) == 3
+
+
+def test_overlay_is_copied_on_write():
+    source = base()
+    row = OverlayRow(source, 'value', 'a', hidden='values')
+    row['id'] = '2'
+    del row['name']
+    assert dict(row) == dict(id='2', value='a')
+    # The base row is never modified
+    assert source == base()
+
+
+def test_overlay_pickles_as_a_dict():
+    row = OverlayRow(base(), 'value', 'a', hidden='values')
+    assert dict(pickle.loads(pickle.dumps(row))) == dict(row)
+
+
+@pytest.mark.parametrize('source_delete', [True, False])
+def test_unwind_copy_on_write_matches_copies(source_delete):
+    def run(copy_on_write):
+        rows = DF.Flow(
+            [base(), dict(id='2', values=[], name='other'), dict(id='3', values='x', name='third')],
+            unwind('values', 'value', source_delete=source_delete, allow_empty=True, copy_on_write=copy_on_write),
+            DF.select_fields(['id', 'value', 'name']),
+        ).results()[0][0]
+        return [dict(row) for row in rows]
+
+    assert run(True) == run(False)